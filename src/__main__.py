@@ -1,4 +1,3 @@
-import asyncio
 import os
 import discord
 from dotenv import load_dotenv
@@ -17,26 +16,47 @@ async def get_prefix(bot: commands.Bot, message: discord.Message):
 intents = discord.Intents.default()
 intents.message_content = True
 
-class MyBot(commands.Bot):
+class _BotSetup:
+    """What every bot does when it starts, whether it's sharded or not"""
+    # Slash commands are global, so with several processes only one of them needs to sync them
+    sync_commands = True
+    # With several processes, only one of them looks after the files they share
+    # (the Opus cache, and the tag cache as songs are added/removed)
+    owns_shared_files = True
+
     async def setup_hook(self):
-        await self.tree.sync()
-
-bot = MyBot(
-    intents=intents,
-    command_prefix=['alexa', 'navi', 'alexa,', 'navi,'],
-    description='Personal Discord Music Bot that can also play local music. Forked from '
-                'https://gist.github.com/vbe0201/ade9b80f2d3b64643d854938d40a0a2d',
-)
-bot.strip_after_prefix = True
-
-
-@bot.event
-async def on_ready():
-    print(
-        'Logged in as:\n'
-        f'Username: {bot.user.name!r}\n'
-        f'ID: {bot.user.id}'
+        # Cogs are added here so they share the bot's event loop (the library watcher needs it)
+        await add_all_cogs(self)
+        if self.sync_commands:
+            await self.tree.sync()
+
+    async def on_ready(self):
+        print(
+            'Logged in as:\n'
+            f'Username: {self.user.name!r}\n'
+            f'ID: {self.user.id}'
+            + (f'\nShards: {self.shard_ids}' if getattr(self, 'shard_ids', None) else '')
+        )
+
+class MyBot(_BotSetup, commands.Bot):
+    pass
+
+class MyShardedBot(_BotSetup, commands.AutoShardedBot):
+    """Runs some of the bot's shards (`shard_ids`, out of `shard_count`). See `sharding.py`"""
+    pass
+
+
+def create_bot(bot_class: type = MyBot, **kwargs) -> commands.Bot:
+    bot = bot_class(
+        intents=intents,
+        command_prefix=['alexa', 'navi', 'alexa,', 'navi,'],
+        description='Personal Discord Music Bot that can also play local music. Forked from '
+                    'https://gist.github.com/vbe0201/ade9b80f2d3b64643d854938d40a0a2d',
+        **kwargs,
     )
+    bot.strip_after_prefix = True
+    return bot
+
 
 async def add_all_cogs(bot):
     """Discord.py 2.0 makes adding cogs an async operation"""
@@ -45,17 +65,27 @@ async def add_all_cogs(bot):
     await bot.add_cog(OracleCog(bot))
 
 
-if __name__ == "__main__":
+def main():
     # Load the .env vars
     load_dotenv()
 
-    # Add the cogs
-    asyncio.run(add_all_cogs(bot))
     # Load the database
     init_database()
-    
+
     try:
         token = os.environ['TOKEN']
     except KeyError:
         raise KeyError("Environment variable 'TOKEN' is not set. Have you created a .env file?")
-    bot.run(token)
+
+    shard_count = os.environ.get("SHARD_COUNT")
+    if shard_count:
+        # Sharded: the shards are split between several processes
+        from .sharding import run_supervisor
+        processes = os.environ.get("SHARD_PROCESSES")
+        run_supervisor(token, int(shard_count), int(processes) if processes else None)
+    else:
+        create_bot().run(token)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,3 +26,45 @@ class GuildSettings(Base):
     archive_channel: int = _sql.Column(_sql.BigInteger, comment="ID of channel")
     def __repr__(self):
         return f"GuildSettings({self.id=}, {self.prefix=}, {self.archive_channel=})"
+
+
+class CachedSongTags(Base):
+    """
+    The tags of a local music file, as of when it was last parsed.
+    If the file's size & modified time haven't changed, we don't need to parse it again.
+
+    Files that aren't songs (cover art, playlists...) are stored too, with no title,
+    so they aren't re-parsed every start-up.
+    """
+    __tablename__   = "SongTagCache"
+    filepath: str   = _sql.Column(_sql.String, primary_key=True)
+    size: int       = _sql.Column(_sql.BigInteger, nullable=False, comment="File size in bytes")
+    mtime_ns: int   = _sql.Column(_sql.BigInteger, nullable=False, comment="Last modified time, nanoseconds")
+    title: str      = _sql.Column(_sql.String, comment="NULL if the file couldn't be parsed")
+    album: str      = _sql.Column(_sql.String)
+    artist: str     = _sql.Column(_sql.String)
+    track_num: int  = _sql.Column(_sql.Integer)
+    disc_num: int   = _sql.Column(_sql.Integer)
+    length: float   = _sql.Column(_sql.Float)
+
+    def __repr__(self):
+        return f"CachedSongTags({self.filepath=}, {self.size=}, {self.mtime_ns=}, {self.title=})"
+
+
+class SavedQueue(Base):
+    """
+    A server's music queue, saved so it can be picked up again after the bot restarts (or crashes).
+
+    Only enough is stored to find each song again (e.g. its URL or filepath),
+    so nothing's looked up until it's about to play
+    """
+    __tablename__           = "SavedQueue"
+    guild_id: int           = _sql.Column(_sql.BigInteger, primary_key=True, comment="ID of server")
+    text_channel_id: int    = _sql.Column(_sql.BigInteger, nullable=False, comment="Where 'Now playing' is sent")
+    voice_channel_id: int   = _sql.Column(_sql.BigInteger, nullable=False)
+    loop: bool              = _sql.Column(_sql.Boolean, nullable=False, default=False)
+    songs: str              = _sql.Column(_sql.String, nullable=False,
+                                          comment="JSON list of [kind, requester ID, data]. The playing song's first")
+
+    def __repr__(self):
+        return f"SavedQueue({self.guild_id=}, {self.text_channel_id=}, {self.voice_channel_id=}, {self.loop=})"
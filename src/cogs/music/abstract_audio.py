@@ -10,6 +10,9 @@ class AbstractAudio(ABC):
     An abstraction layer that provides data about a given audio, and allows lazy loading of audio sources.
     """
 
+    # When (`time.monotonic()`) the command that queued it was sent, if it's known
+    requested_at: Optional[float] = None
+
     @abstractmethod
     async def generate_source(self) -> AudioSource:
         ...
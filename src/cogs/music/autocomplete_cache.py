@@ -0,0 +1,68 @@
+"""
+Remembers recent autocomplete matches, so typing "Mezz", "Mezza", "Mezzan"...
+only searches the library once.
+"""
+import threading
+from collections import OrderedDict
+from typing import FrozenSet, NamedTuple, Optional, Set, Tuple
+
+# (the field being typed in, the other fields' values)
+CacheKey = Tuple[str, FrozenSet[Tuple[str, str]]]
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int
+    currsize: int
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class PrefixCache:
+    """
+    An LRU cache of the values that matched the last query typed into each field.
+
+    If the next query starts with the last one, only those values can still match
+    (the user's just typed more), so they're all that needs re-scoring.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[CacheKey, Tuple[str, Set[str]]]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: CacheKey, normalized_query: str) -> Optional[Set[str]]:
+        """The values that matched a shorter version of this query, or None if there aren't any"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry[0] or not normalized_query.startswith(entry[0]):
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def store(self, key: CacheKey, normalized_query: str, matched_values: Set[str]):
+        with self._lock:
+            self._entries[key] = (normalized_query, matched_values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        """Forgets every entry, e.g. because songs were added (which might match now)"""
+        with self._lock:
+            self._entries.clear()
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses, self._evictions, self.maxsize, len(self._entries))
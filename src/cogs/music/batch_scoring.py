@@ -0,0 +1,36 @@
+"""
+Fuzzy-matches a query against a whole column of strings at once.
+
+All the scoring happens inside rapidfuzz's native code, instead of one Python call per song.
+"""
+from typing import Callable, List, Mapping, Sequence, Tuple, Union
+
+from rapidfuzz import fuzz, process
+
+Column = Union[Sequence[str], Mapping[int, str]]
+
+
+def score_column(
+    query: str,
+    column: Column,
+    score_cutoff: float,
+    min_length: int = 0,
+    scorer: Callable = fuzz.ratio,
+) -> List[Tuple[int, float]]:
+    """
+    Scores `query` against every string in `column`, best matches first.
+
+    `column` is either a list of strings, or a {position: string} mapping for a subset of one.
+    Returns (position, score) for every string scoring at least `score_cutoff`,
+    and at least `min_length` characters long.
+    """
+    matches = process.extract(
+        query,
+        column,
+        scorer=scorer,
+        processor=None,
+        score_cutoff=score_cutoff,
+        limit=None,
+    )
+    # Only the matches (a handful) get length-checked, not the whole column
+    return [(position, score) for (choice, score, position) in matches if len(choice) >= min_length]
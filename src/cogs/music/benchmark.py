@@ -0,0 +1,244 @@
+"""
+Benchmarks the local library's searching, on made-up libraries (no music folder needed).
+
+Run with `python -m src.cogs.music.benchmark`. Results are printed as JSON,
+so runs from different commits can be compared.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from .find_local_audio import LOAD_BATCH_SIZE, LocalAudioLibrary
+from .song_data import SongData
+from .song_store import FIELDS
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_QUERIES = 200               # How many times each operation's timed
+SONGS_PER_ARTIST = 100              # Roughly. So 1M songs have ~10k artists
+VOCABULARY_SIZE = 20_000            # Distinct words used in titles/albums/artists
+ZIPF_EXPONENT = 1.1                 # How heavily the popular words/artists are favoured
+
+_SYLLABLES = ("ka", "ri", "mo", "na", "lu", "se", "to", "vi", "da", "el", "on", "ar", "mi", "su", "be",
+              "gra", "tho", "str", "ein", "qu", "zé", "nö", "ça", "ñu", "ø", "ly", "ch", "ia", "or", "us")
+_TITLE_SUFFIXES = (" (Live)", " (Remastered)", " (Remastered 2011)", " - Radio Edit", " (Acoustic)", " (Demo)")
+
+
+def _zipf_cum_weights(n: int) -> List[float]:
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, n + 1):
+        total += 1 / rank ** ZIPF_EXPONENT
+        cum_weights.append(total)
+    return cum_weights
+
+
+def _make_word(rng: random.Random) -> str:
+    return "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4))).capitalize()
+
+
+def generate_library(n_songs: int, seed: int = 0) -> List[SongData]:
+    """
+    `n_songs` made-up songs, tagged roughly like a real collection:
+    a few artists have most of the albums, common words show up in lots of titles,
+    albums have 8-16 tracks (sometimes across 2 discs), and some titles are live versions, remasters, etc.
+    """
+    rng = random.Random(seed)
+    vocabulary = list({_make_word(rng) for _ in range(VOCABULARY_SIZE)})
+    word_weights = _zipf_cum_weights(len(vocabulary))
+
+    def words(lo: int, hi: int) -> str:
+        return " ".join(rng.choices(vocabulary, cum_weights=word_weights, k=rng.randint(lo, hi)))
+
+    artists = [words(1, 3) for _ in range(max(1, n_songs // SONGS_PER_ARTIST))]
+    artist_weights = _zipf_cum_weights(len(artists))
+    songs = []
+    albums = set()
+    while len(songs) < n_songs:
+        artist = rng.choices(artists, cum_weights=artist_weights)[0]
+        album = words(1, 4)
+        # Lots of artists have a "Greatest Hits", but not two of them (their files would clash)
+        if (artist, album) in albums:
+            continue
+        albums.add((artist, album))
+        n_discs = 2 if rng.random() < 0.05 else 1
+        for disc_num in range(1, n_discs + 1):
+            for track_num in range(1, rng.randint(8, 16) + 1):
+                title = words(1, 5)
+                if rng.random() < 0.05:
+                    title += rng.choice(_TITLE_SUFFIXES)
+                if rng.random() < 0.03:
+                    title += f" (feat. {rng.choice(artists)})"
+                songs.append(SongData(
+                    album=album,
+                    track_num=track_num,
+                    artist=artist,
+                    title=title,
+                    filepath=f"/music/{artist}/{album}/{disc_num}-{track_num:02} {title}.flac",
+                    length=round(rng.gauss(215, 60), 2),
+                    disc_num=disc_num if n_discs > 1 else None,
+                ))
+    return songs[:n_songs]
+
+
+def build_library(songs: List[SongData]) -> LocalAudioLibrary:
+    """Indexes the songs in batches, like `LocalAudioLibrary.load()` does"""
+    library = LocalAudioLibrary(["/music"])
+    for start in range(0, len(songs), LOAD_BATCH_SIZE):
+        library.apply_changes(songs[start:start + LOAD_BATCH_SIZE], removed=())
+    for progress in library.folder_progress.values():
+        progress.finished = True
+    return library
+
+
+def _typed_query(rng: random.Random, value: str) -> str:
+    """What someone might've typed so far, looking for `value`"""
+    if rng.random() < 0.2:
+        # Part of a later word, e.g. "ain't" for "Two Out Of Three Ain't Bad"
+        start = rng.randrange(len(value))
+        return value[start:start + rng.randint(2, 10)]
+    return value[:rng.randint(2, min(len(value), 12))]
+
+
+def _percentiles(timings: List[float]) -> Dict[str, float]:
+    if len(timings) < 2:
+        timings = timings * 2
+    cut_points = statistics.quantiles(timings, n=100, method="inclusive")
+    return {
+        "n": len(timings),
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "p50_ms": cut_points[49] * 1000,
+        "p95_ms": cut_points[94] * 1000,
+        "p99_ms": cut_points[98] * 1000,
+        "max_ms": max(timings) * 1000,
+    }
+
+
+def _time_each(inputs: list, operation: Callable) -> Dict[str, float]:
+    timings = []
+    for args in inputs:
+        start = time.perf_counter()
+        operation(*args)
+        timings.append(time.perf_counter() - start)
+    return _percentiles(timings)
+
+
+def benchmark_operations(library: LocalAudioLibrary, songs: List[SongData],
+                         n_queries: int, seed: int) -> Dict[str, Dict[str, float]]:
+    rng = random.Random(seed)
+    picks = rng.choices(songs, k=n_queries)
+    never_stop = lambda: False
+    results = {}
+
+    def autocomplete(query: str, attr_name: str, other_fields: Dict[str, str]):
+        library._search_autocomplete(query, attr_name, other_fields, never_stop)
+
+    def autocomplete_cold(query: str, attr_name: str, other_fields: Dict[str, str]):
+        library.autocomplete_cache.clear()
+        autocomplete(query, attr_name, other_fields)
+
+    results["find_possible_songs.title"] = _time_each(
+        [(song.title,) for song in picks], lambda title: library.find_possible_songs(title=title))
+    results["find_possible_songs.album"] = _time_each(
+        [(song.album,) for song in picks], lambda album: library.find_possible_songs(album=album))
+    results["find_possible_songs.title_artist"] = _time_each(
+        [(song.title, song.artist) for song in picks],
+        lambda title, artist: library.find_possible_songs(title=title, artist=artist))
+
+    results["autocomplete.random_values"] = _time_each(
+        [(rng.choice(FIELDS),) for _ in picks], library._autocomplete_give_random_values)
+    for attr_name in FIELDS:
+        results[f"autocomplete.typed.{attr_name}"] = _time_each(
+            [(_typed_query(rng, getattr(song, attr_name)), attr_name, {}) for song in picks], autocomplete_cold)
+    # Typing one letter at a time, so every keystroke after the first can re-use the last one's matches
+    keystrokes = [(song.title[:length], "title", {})
+                  for song in picks[:max(1, n_queries // 8)]
+                  for length in range(2, min(len(song.title), 12) + 1)]
+    library.autocomplete_cache.clear()
+    results["autocomplete.keystrokes.title"] = _time_each(keystrokes, autocomplete)
+    results["autocomplete.typed.title_with_album"] = _time_each(
+        [(_typed_query(rng, song.title), "title", {"album": song.album}) for song in picks], autocomplete_cold)
+    results["autocomplete.other_fields_only.title_with_album"] = _time_each(
+        [("", "title", {"album": song.album}) for song in picks], autocomplete)
+    results["autocomplete.other_fields_only.album_with_artist"] = _time_each(
+        [("", "album", {"artist": song.artist}) for song in picks], autocomplete)
+    return results
+
+
+def benchmark_size(n_songs: int, n_queries: int, seed: int, measure_memory: bool = True) -> dict:
+    print(f"Generating {n_songs} songs...", file=sys.stderr)
+    songs = generate_library(n_songs, seed)
+
+    print("Indexing...", file=sys.stderr)
+    start = time.perf_counter()
+    library = build_library(songs)
+    build_seconds = time.perf_counter() - start
+    library.close()
+    del library
+
+    memory = {}
+    if measure_memory:
+        # Again, for memory. Tracing slows things down a lot, so it's not timed
+        tracemalloc.start()
+        library = build_library(songs)
+        (memory["retained_bytes"], memory["peak_bytes"]) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        library = build_library(songs)
+    memory.update(library.memory_report())
+
+    print("Searching...", file=sys.stderr)
+    operations = benchmark_operations(library, songs, n_queries, seed)
+    library.close()
+    return {
+        "songs": n_songs,
+        "index_build": {"seconds": build_seconds, "songs_per_second": n_songs / build_seconds},
+        "memory": memory,
+        "operations": operations,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="How many songs each library has (default: %(default)s)")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES,
+                        help="How many times each operation's timed (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-memory", action="store_true",
+                        help="Don't trace peak memory while indexing (it makes indexing ~5x slower)")
+    parser.add_argument("--output", default="-", help="Where to write the JSON results (default: stdout)")
+    args = parser.parse_args()
+
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "queries": args.queries,
+        "results": [benchmark_size(n_songs, args.queries, args.seed, measure_memory=not args.skip_memory)
+                    for n_songs in args.sizes],
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,52 @@
 """
 A class for searching local files
 """
+import asyncio
+import heapq
+import itertools
 import logging
-import os
 import multiprocessing
-import random
+import os
+import queue
+import threading
+import time
+from array import array
+from bisect import insort
 from collections import defaultdict
+from collections.abc import Collection, Mapping
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from math import inf
-from pathlib import Path
-from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 import discord
 from music_tag import load_file
 from music_tag.id3 import Id3File
-from thefuzz import fuzz, process
+from rapidfuzz import fuzz
+
+from .autocomplete_cache import PrefixCache
+from .batch_scoring import score_column
+from .ngram_index import NGramIndex
+from .normalize import normalize_value
+from .read_write_lock import ReadWriteLock
+from .song_data import SongData
+from .song_store import FIELDS, SongStore, intersect_sorted
+from .value_sampler import ValueSampler
+from .tag_cache import ScanSummary, TagCache, walk_music_folder
+from .top_k import Rank, TopK
 
 AUTOCOMPLETE_MIN_SIMILARITY = 85    # When giving auto-complete options, we'll match 85% similarity
 SELECTION_MIN_SIMILARITY = 95       # When actually picking the songs, it'll match anything 95% similar
 DISCORD_AUTOCOMPLETE_LIMIT = 25     # Discord autocomplete only allows 25 suggestions max
+AUTOCOMPLETE_CACHE_SIZE = 256       # How many recent (field, other fields) searches are remembered
+AUTOCOMPLETE_CACHE_SLACK = 15       # Values this close to matching are remembered too, as typing more can make them match
+AUTOCOMPLETE_PLAYED_SHARE = 0.2     # When suggesting random values, 20% of them favour recently/often played ones
+AUTOCOMPLETE_DEADLINE_SECONDS = 2.5 # Discord ignores autocomplete answers after 3 seconds, so give what we've got by then
+AUTOCOMPLETE_CHECK_INTERVAL = 64    # How many values are scored between checking if a search should give up
+AUTOCOMPLETE_WORKERS = 2            # Threads searching for autocomplete suggestions
+LOAD_BATCH_SIZE = 1000              # While loading, songs are added to the library this many at a time
+PARSE_CHUNK_SIZE = 32               # Files handed to each parser process at a time
+BATCH_INTERVAL_SECONDS = 0.5        # If parsing's slow, hand over whatever's been found this often
+PROGRESS_INTERVAL_SECONDS = 10      # How often scanning progress is printed
 
 
 logger = logging.getLogger(__name__)
@@ -33,55 +61,6 @@ def get_song_data(filename: str) -> "SongData | None":
     except Exception as e:
         logger.error(f"Error parsing file {filename!r}: {type(e).__name__}: {e!r}")
 
-@dataclass(frozen=True)
-class SongData:
-    """Class for storing information about a local audio file"""
-
-    album: str
-    track_num: int
-    artist: str
-    title: str
-    filepath: str
-    length: float
-
-    @staticmethod
-    def from_music_tag(song_data: Id3File) -> "SongData":
-        title = song_data.resolve("tracktitle").value
-        # If a file has no title attribute, use its filename (minus the extension)
-        if not title:
-            title = Path(song_data.filename).stem
-
-        return SongData(
-            album=song_data.resolve("album").value or "<None>",
-            track_num=song_data.resolve("tracknumber").value or "<None>",
-            artist=song_data.resolve("artist").value or "<None>",
-            length=song_data.resolve("#length").value,
-            title=title,
-            filepath=song_data.filename,
-        )
-    
-    def __hash__(self) -> int:
-        return hash(self.filepath)
-    
-    def __eq__(self, other: object) -> bool:
-        """True if they both point to the same file"""
-        return isinstance(other, self.__class__) and self.filepath == other.filepath
-    
-    def __lt__(self, other: 'SongData') -> bool:
-        """
-        Used for sorting songs by their track number 
-
-        If a song has no track number, it'll be sorted to the end of the list
-        If songs share a track number it'll sort by the title alphabetically
-        """
-        self_track_num = self.track_num if isinstance(self.track_num, int) else inf
-        other_track_num = other.track_num if isinstance(other.track_num, int) else inf
-
-        return (self_track_num, self.title.lower()) < (other_track_num, other.title.lower())
-
-
-
-
 def _get_other_autocomplete_fields(interaction: discord.Interaction) -> Dict[str, str]:
     other_fields = {}
     for field in interaction.data["options"]:
@@ -91,16 +70,141 @@ def _get_other_autocomplete_fields(interaction: discord.Interaction) -> Dict[str
     return other_fields
 
 
-def _get_all_songs(filepath: str) -> List[SongData]:
-    all_songs = []
-    for (dirname, _, filenames) in os.walk(filepath):
-        for fname in filenames:
-            full_path = os.path.join(dirname, fname)
-            all_songs.append(full_path)
-    print(len(all_songs), "files found, parsing (This may take a while)")
+@dataclass
+class ScanProgress:
+    """How far through scanning a music folder (or all of them) we are"""
+    files_found: int = 0
+    files_done: int = 0
+    finished: bool = False
+
+    @property
+    def percent(self) -> int:
+        if self.finished:
+            return 100
+        return self.files_done * 100 // self.files_found if self.files_found else 0
+
+
+def default_scan_workers() -> int:
+    """One parser per CPU core this process is allowed to use"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:     # Not available on Windows/Mac
+        return os.cpu_count() or 1
+
+
+def _parse_files(chunk: List[Tuple[str, int, int]]) -> List[Tuple[Tuple[str, int, int], "SongData | None"]]:
+    """Runs in a worker process. Returns each (filepath, size, mtime_ns) alongside its result"""
+    return [(entry, get_song_data(entry[0])) for entry in chunk]
+
+
+def _scan_songs(
+    filepath: str,
+    cache: TagCache,
+    progress: ScanProgress,
+    workers: Optional[int] = None,
+) -> Iterator[List[SongData]]:
+    """
+    Finds every song in `filepath`, yielding them in batches as they're found.
+    Only files that are new (or changed) since the last start-up get parsed, the rest come from the tag cache.
+
+    Files are parsed by a pool of `workers` processes while the folder's still being walked,
+    and each result is handed back as soon as it's ready.
+    The pool's only started once there's a file to parse, so an up-to-date tag cache doesn't start one at all.
+    """
+    summary = ScanSummary()
+    seen = set()
+    cached_songs: "queue.SimpleQueue[SongData]" = queue.SimpleQueue()
+
+    def chunks_to_parse() -> Iterator[List[Tuple[str, int, int]]]:
+        # Runs here until the first file to parse, then in the pool's task-feeding thread.
+        # An empty chunk means a batch of cached songs is waiting to be handed over
+        chunk = []
+        for (full_path, size, mtime_ns) in walk_music_folder(filepath):
+            seen.add(full_path)
+            progress.files_found += 1
+            if cache.is_fresh(full_path, size, mtime_ns):
+                summary.hits += 1
+                progress.files_done += 1
+                song = cache.get(full_path)
+                if song is not None:
+                    cached_songs.put(song)
+                    if cached_songs.qsize() >= LOAD_BATCH_SIZE:
+                        yield []
+            else:
+                summary.misses += 1
+                chunk.append((full_path, size, mtime_ns))
+                if len(chunk) >= PARSE_CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    workers = workers or default_scan_workers()
+    batch: List[SongData] = []
+    last_report = time.monotonic()
+
+    def report_progress():
+        nonlocal last_report
+        if time.monotonic() - last_report >= PROGRESS_INTERVAL_SECONDS:
+            last_report = time.monotonic()
+            print(f"Scanning {filepath}: {progress.files_done}/{progress.files_found} file(s) done, "
+                  f"{summary.misses} parsed by {workers} worker(s)")
+
+    # The folder's walked here (handing over cached songs) until there's a file to parse
+    chunks = chunks_to_parse()
+    to_parse = None
+    for chunk in chunks:
+        while not cached_songs.empty():
+            batch.append(cached_songs.get())
+        if len(batch) >= LOAD_BATCH_SIZE:
+            yield batch
+            batch = []
+        report_progress()
+        if chunk:
+            to_parse = itertools.chain([chunk], (chunk for chunk in chunks if chunk))
+            break
 
-    pool = multiprocessing.Pool(16)
-    return list(filter(None, pool.map(get_song_data, all_songs)))
+    if to_parse is not None:
+        # Spawned rather than forked: this runs in a worker thread, and forking while other threads
+        # (the event loop, autocomplete, other folders' scans) hold locks can leave a child stuck on one
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            # Chunked by hand: `imap_unordered(chunksize=...)` returns a plain generator, which has no timeout
+            results = pool.imap_unordered(_parse_files, to_parse)
+            while True:
+                try:
+                    parsed_chunk = results.next(timeout=BATCH_INTERVAL_SECONDS)
+                except multiprocessing.TimeoutError:
+                    waiting = True
+                except StopIteration:
+                    break
+                else:
+                    waiting = False
+                    for ((full_path, size, mtime_ns), song) in parsed_chunk:
+                        cache.update(full_path, size, mtime_ns, song)
+                        progress.files_done += 1
+                        if song is not None:
+                            batch.append(song)
+
+                while not cached_songs.empty():
+                    batch.append(cached_songs.get())
+                # Hand songs over in big batches, or whatever we've got if parsing's slow
+                if len(batch) >= LOAD_BATCH_SIZE or (waiting and batch):
+                    yield batch
+                    batch = []
+                report_progress()
+            # Everything's parsed, so let the workers exit cleanly
+            pool.close()
+            pool.join()
+    while not cached_songs.empty():
+        batch.append(cached_songs.get())
+    yield batch
+
+    # Anything we cached last time, but isn't there anymore, was deleted
+    for deleted_path in cache.paths_under(filepath) - seen:
+        cache.remove(deleted_path)
+        summary.removed += 1
+    cache.commit()
+    print(f"{len(seen)} files found in {filepath}. Tag cache: {summary}")
 
 def get_x_unique_values(items: Iterable, x: int) -> Iterable:
     """Returns upto `x` non-duplicate items from `items`"""
@@ -115,115 +219,460 @@ def get_x_unique_values(items: Iterable, x: int) -> Iterable:
 
 
 
-def _tag_processor(
-    attr_name,
-) -> Callable[[Union[str, SongData]], str]:
-    def inner(song_data) -> str:
-        # Might be a tuple of type (song, confidence)
-        while isinstance(song_data, tuple):
-            song_data = song_data[0]
-        # Check 1: It's a raw SongData from all_songs or something.
-        # So, get the string property we want
-        if isinstance(song_data, SongData):
-            return getattr(song_data, attr_name).lower()
-        # This check exists before the processor is run against the query as well
-        elif isinstance(song_data, str):
-            return song_data.lower()
+class _AllSongs(Collection):
+    """A read-only view of every song in the store, as SongData"""
+
+    def __init__(self, store: SongStore):
+        self._store = store
+
+    def __len__(self):
+        return len(self._store)
 
-    return inner
+    def __iter__(self) -> Iterator[SongData]:
+        return map(self._store.song, self._store.rows())
+
+    def __contains__(self, song: object) -> bool:
+        return isinstance(song, SongData) and self._store.row_of(song.filepath) is not None
+
+
+class _SongsByValue(Mapping):
+    """A read-only `{value: set of SongData}` view of one field"""
+
+    def __init__(self, store: SongStore, attr_name: str):
+        self._store = store
+        self._attr_name = attr_name
+
+    def __getitem__(self, value: str) -> Set[SongData]:
+        value_id = self._store.tables[self._attr_name].id_of(value)
+        rows = self._store.rows_with_value[self._attr_name][value_id] if value_id is not None else ()
+        if not rows:
+            raise KeyError(value)
+        return {self._store.song(row) for row in rows}
+
+    def __iter__(self) -> Iterator[str]:
+        strings = self._store.tables[self._attr_name].strings
+        return (strings[value_id]
+                for (value_id, rows) in enumerate(self._store.rows_with_value[self._attr_name])
+                if rows)
+
+    def __len__(self):
+        return sum(1 for rows in self._store.rows_with_value[self._attr_name] if rows)
 
 
 class LocalAudioLibrary:
-    all_songs: List[SongData]
-
-    def __init__(self, audio_directory: str):
-        print(f"Searching {audio_directory} for songs, please wait...")
-        self.all_songs = _get_all_songs(audio_directory)
-        print(f"Found {len(self.all_songs)} song(s)")
-        self.field_to_song: Dict[str, Dict[str, Set[SongData]]] = {
-            "title": defaultdict(set),
-            "artist": defaultdict(set),
-            "album": defaultdict(set),
+    store: SongStore
+
+    def __init__(self, audio_directories: Sequence[str]):
+        """Creates an empty library of the songs in every one of `audio_directories`. Call `load()` to find them"""
+        self.audio_directories = list(audio_directories)
+        # Each folder's scanned separately, with its own cache, so a slow one doesn't hold up the others
+        self.tag_caches: Dict[str, TagCache] = {}
+        self.folder_progress: Dict[str, ScanProgress] = {
+            folder: ScanProgress() for folder in self.audio_directories
+        }
+        # Songs from every folder are searched together
+        self.store = SongStore()
+        # Shortlists which values are worth fuzzy-matching during autocomplete
+        self.field_ngrams: Dict[str, NGramIndex] = {
+            attr_name: NGramIndex() for attr_name in FIELDS
+        }
+        # Picks random values to suggest when nothing's been typed
+        self.field_samplers: Dict[str, ValueSampler] = {
+            attr_name: ValueSampler() for attr_name in FIELDS
         }
-        for song in self.all_songs:
-            self.field_to_song["title"][song.title].add(song)
-            self.field_to_song["artist"][song.artist].add(song)
-            self.field_to_song["album"][song.album].add(song)
+        self.autocomplete_cache = PrefixCache(maxsize=AUTOCOMPLETE_CACHE_SIZE)
+        # album value id -> its songs' rows, in disc/track order. Each song's slotted in as it's added
+        self._album_tracklists: Dict[int, array] = {}
+        # Autocomplete searches run in these threads, so a slow one doesn't freeze the event loop.
+        # They share `_index_lock` while reading the library (so they can search at the same time),
+        # and `apply_changes` has it to itself while changing it
+        self._autocomplete_executor = ThreadPoolExecutor(max_workers=AUTOCOMPLETE_WORKERS,
+                                                         thread_name_prefix="autocomplete")
+        self._index_lock = ReadWriteLock()
+        # user id -> set to cancel their latest autocomplete search
+        self._autocomplete_requests: Dict[int, threading.Event] = {}
+
+    @property
+    def progress(self) -> ScanProgress:
+        """How far through scanning every folder we are"""
+        return ScanProgress(
+            files_found=sum(progress.files_found for progress in self.folder_progress.values()),
+            files_done=sum(progress.files_done for progress in self.folder_progress.values()),
+            finished=all(progress.finished for progress in self.folder_progress.values()),
+        )
 
-    def find_possible_songs(self, **kwargs) -> List[SongData]:
-        best = self.all_songs
+    @property
+    def is_loaded(self) -> bool:
+        return self.progress.finished
+
+    def tag_cache_for(self, filepath: str) -> Optional[TagCache]:
+        """The cache of whichever music folder `filepath` is in (None if that folder's not been scanned yet)"""
+        for (folder, cache) in list(self.tag_caches.items()):
+            if filepath == folder or filepath.startswith(os.path.join(folder, "")):
+                return cache
+        return None
+
+    async def load(self, workers: Optional[int] = None, on_folder_loaded: Optional[Callable[[str], None]] = None):
+        """
+        Scans every music folder at once, each in its own worker thread, so the event loop (and the bot) keeps running.
+        Songs are added as they're found, so they can be searched before loading's finished.
+
+        `workers` is how many processes parse files, split between the folders. Defaults to one per CPU core.
+        `on_folder_loaded(folder)` is called as each folder finishes.
+        A folder that can't be scanned (e.g. a network drive that's gone offline) is logged and skipped.
+        """
+        workers_per_folder = max(1, (workers or default_scan_workers()) // len(self.audio_directories))
+        results = await asyncio.gather(*(
+            self._load_folder(folder, workers_per_folder, on_folder_loaded) for folder in self.audio_directories
+        ), return_exceptions=True)
+        for (folder, result) in zip(self.audio_directories, results):
+            if isinstance(result, Exception):
+                logger.error(f"Couldn't scan {folder}", exc_info=result)
+        print(f"Found {len(self.store)} song(s)")
+
+    async def _load_folder(self, folder: str, workers: int, on_folder_loaded: Optional[Callable[[str], None]]):
+        print(f"Searching {folder} for songs, please wait...")
+        loop = asyncio.get_running_loop()
+        found_batches: asyncio.Queue[Optional[List[SongData]]] = asyncio.Queue()
+        progress = self.folder_progress[folder]
+
+        def scan():
+            try:
+                cache = TagCache(folder)
+                for batch in _scan_songs(folder, cache, progress, workers):
+                    loop.call_soon_threadsafe(found_batches.put_nowait, batch)
+                self.tag_caches[folder] = cache
+            finally:
+                loop.call_soon_threadsafe(found_batches.put_nowait, None)
+
+        scanning = loop.run_in_executor(None, scan)
+        try:
+            # The indexing happens here, on the event loop, so it's never changed by two threads at once
+            while (batch := await found_batches.get()) is not None:
+                await self.apply_changes_without_blocking(batch, removed=())
+            await scanning
+        finally:
+            # Even if it failed, it's not being scanned anymore
+            progress.finished = True
+        if on_folder_loaded is not None:
+            on_folder_loaded(folder)
+
+    @property
+    def all_songs(self) -> Collection[SongData]:
+        return _AllSongs(self.store)
+
+    @property
+    def field_to_song(self) -> Dict[str, Mapping[str, Set[SongData]]]:
+        return {attr_name: _SongsByValue(self.store, attr_name) for attr_name in FIELDS}
+
+    def memory_report(self) -> Dict[str, int]:
+        """How much memory the songs take up, compared to storing them as SongData objects"""
+        return self.store.memory_report()
+
+    def _index_song(self, song: SongData):
+        row = self.store.add(song)
+        tracklist = self._album_tracklists.setdefault(self.store.value_ids["album"][row], array("I"))
+        insort(tracklist, row, key=self.store.track_order)
+        for attr_name in FIELDS:
+            value_id = self.store.value_ids[attr_name][row]
+            # First song with this value, so it can be suggested now
+            if len(self.store.rows_with_value[attr_name][value_id]) == 1:
+                table = self.store.tables[attr_name]
+                self.field_ngrams[attr_name].add(table.strings[value_id], table.normalized[value_id])
+                self.field_samplers[attr_name].add(table.strings[value_id])
+
+    def _unindex_song(self, row: int):
+        value_ids = {attr_name: self.store.value_ids[attr_name][row] for attr_name in FIELDS}
+        tracklist = self._album_tracklists[value_ids["album"]]
+        tracklist.remove(row)
+        if not tracklist:
+            del self._album_tracklists[value_ids["album"]]
+        self.store.remove(row)
+        for (attr_name, value_id) in value_ids.items():
+            # Don't keep suggesting an album once its last song is gone
+            if not self.store.rows_with_value[attr_name][value_id]:
+                value = self.store.tables[attr_name].strings[value_id]
+                self.field_ngrams[attr_name].remove(value)
+                self.field_samplers[attr_name].remove(value)
+
+    def get_song(self, filepath: str) -> Optional[SongData]:
+        """
+        For worker threads (e.g. the library watcher's), as it waits for any changes to the library to finish.
+        Don't call it on the event loop, where the changes happen
+        """
+        with self._index_lock.reading():
+            row = self.store.row_of(filepath)
+            return self.store.song(row) if row is not None else None
+
+    def apply_changes(self, updated: Iterable[SongData], removed: Iterable[str]):
+        """
+        Updates the library in-place, in one batch.
+
+        `updated` are new or re-tagged songs, `removed` are the filepaths of deleted songs.
+        Blocks until any running autocomplete searches have given up, so use `apply_changes_without_blocking()`
+        on the event loop.
+        """
+        with self._index_lock.writing():
+            self._change_index(list(updated), removed)
+
+    async def apply_changes_without_blocking(self, updated: Iterable[SongData], removed: Iterable[str]):
+        """
+        `apply_changes()`, for the event loop: waits for autocomplete searches to give up without blocking it,
+        and applies big batches `LOAD_BATCH_SIZE` songs at a time, so the bot can do other things in between.
+
+        The changes still happen on the event loop, as everything else there reads the library without locking it.
+        """
+        updated = list(updated)
+        removed = list(removed)
+        for start in range(0, max(len(updated), len(removed)), LOAD_BATCH_SIZE):
+            async with self._index_lock.writing_async():
+                self._change_index(updated[start:start + LOAD_BATCH_SIZE], removed[start:start + LOAD_BATCH_SIZE])
+
+    def _change_index(self, updated: List[SongData], removed: Iterable[str]):
+        stale_paths = set(removed).union(song.filepath for song in updated)
+        for path in stale_paths:
+            row = self.store.row_of(path)
+            if row is not None:
+                self._unindex_song(row)
+        for song in updated:
+            self._index_song(song)
+        # New songs might match queries that previously didn't
+        self.autocomplete_cache.clear()
+
+    def close(self):
+        """Stops any running autocomplete searches. The library can't be autocompleted afterwards"""
+        for cancelled in self._autocomplete_requests.values():
+            cancelled.set()
+        self._autocomplete_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _album_rows(self, album: str) -> Sequence[int]:
+        album_id = self.store.tables["album"].id_of(album)
+        return self._album_tracklists.get(album_id, ()) if album_id is not None else ()
+
+    def album_tracklist(self, album: str, artist: Optional[str] = None) -> List[SongData]:
+        """
+        Every song on the album (optionally, only the ones by `artist`), in disc/track order.
+
+        The names must match exactly (like when they're picked from autocomplete), no searching is done.
+        Empty if there's no such album.
+        """
+        rows = self._album_rows(album)
+        if artist:
+            rows = [row for row in rows if self.store.value("artist", row) == artist]
+        return [self.store.song(row) for row in rows]
 
-        def _merge(sd: Union[SongData, Tuple[SongData, int]]):
-            total_conf = 0
-            # 
-            while isinstance(sd, tuple):
-                total_conf += sd[1]
-                sd = sd[0]
-            return (sd, total_conf)
+    def in_album_order(self, songs: Iterable[SongData]) -> List[SongData]:
+        """
+        Puts the songs in tracklist order, album-by-album (in the order each album first appears).
+        Uses the pre-sorted tracklists, so nothing gets sorted here
+        """
+        wanted_rows = {}
+        for song in songs:
+            row = self.store.row_of(song.filepath)
+            if row is not None:
+                wanted_rows.setdefault(song.album, set()).add(row)
+        return [self.store.song(row)
+                for (album, rows) in wanted_rows.items()
+                for row in self._album_rows(album)
+                if row in rows]
+
+    def find_possible_songs(self, **kwargs) -> List[SongData]:
+        # Rows that match every field so far. None means "everything"
+        best: Optional[List[int]] = None
 
         for (attr_name, query) in kwargs.items():
             if attr_name and query:
-                # Don't accept anything longer than the query string (searching "Mezzanine" shouldn't match "Me")
-                best = [
-                    song
-                    for song in best
-                    if len(_tag_processor(attr_name)(song)) >= len(query)
-                ]
-                best = process.extractBests(
-                    query,
-                    best,
-                    processor=_tag_processor(attr_name),
-                    scorer=fuzz.ratio,  # Scorer to be improved
+                table = self.store.tables[attr_name]
+                if best is None:
+                    # Every song with the same value gets the same score, so only score each value once
+                    column = table.normalized
+                    rows_with_value = self.store.rows_with_value[attr_name]
+                else:
+                    # Only re-score the songs that matched the previous fields
+                    rows_with_value = defaultdict(list)
+                    value_ids = self.store.value_ids[attr_name]
+                    for row in best:
+                        rows_with_value[value_ids[row]].append(row)
+                    column = {value_id: table.normalized[value_id] for value_id in rows_with_value}
+                normalized_query = normalize_value(query)
+                matches = score_column(
+                    normalized_query,
+                    column,
                     score_cutoff=SELECTION_MIN_SIMILARITY,
-                    limit=None,
+                    # Don't accept anything shorter than the query string (searching "Mezzanine" shouldn't match "Me")
+                    min_length=len(normalized_query),
                 )
-                # print(f"{attr_name!r} search. {len(best)} result(s):")
-                # best = [_merge(entry) for entry in best]
-                # pprint.pprint(best[:10])
-                # print("===")
+                best = [row for (value_id, _conf) in matches for row in rows_with_value[value_id]]
+
+        if best is None:
+            return list(self.all_songs)
+        return [self.store.song(row) for row in best]
 
-        return [song for (song, _conf) in best]
+    def record_play(self, song: SongData, already_counted: Optional[Set[Tuple[str, str]]] = None):
+        """
+        Makes the song's title/artist/album more likely to be suggested when a field's empty.
+        Values in `already_counted` (as (field, value)) are skipped, and the ones counted are added to it
+        """
+        for attr_name in FIELDS:
+            value = getattr(song, attr_name)
+            if already_counted is not None:
+                if (attr_name, value) in already_counted:
+                    continue
+                already_counted.add((attr_name, value))
+            self.field_samplers[attr_name].record_play(value)
 
     def _autocomplete_give_random_values(self, attr_name) -> List[str]:
-        all_options = list(self.field_to_song[attr_name].keys())
-        random.shuffle(all_options)
-        return all_options
+        return self.field_samplers[attr_name].sample(DISCORD_AUTOCOMPLETE_LIMIT, played_share=AUTOCOMPLETE_PLAYED_SHARE)
     
-    def _autocomplete_give_closest_match(self, query: str, attr_name: str, other_autocomplete_fields: Dict[str, str]) -> Iterable[SongData]:
-        """Uses fuzzy search to find the closest match"""
-        possible_songs = self._autocomplete_filtered_from_other_fields(other_autocomplete_fields)
-        get_tag = _tag_processor(attr_name)
-        # If the `query` is longer than the searched field, don't consider it.
-        # This is so searching for, e.g., "Mezzanine" doesn't cause "Me" to show up
-        possible_songs = filter(lambda s: len(query) <= len(get_tag(s)), possible_songs)
-        possible_songs = process.extractBests(
-            query=query,
-            choices=possible_songs,
-            processor=get_tag,
-            scorer=fuzz.partial_ratio,  # Scorer to be improved
-            score_cutoff=AUTOCOMPLETE_MIN_SIMILARITY,
-            limit=None
-        )
-
-        # Sort by highest confidence, then by string length similarity
+    def _autocomplete_give_closest_match(self, query: str, attr_name: str, other_autocomplete_fields: Dict[str, str],
+                                         should_stop: Callable[[], bool] = lambda: False) -> Iterable[SongData]:
+        """
+        Uses fuzzy search to find the closest matches, up to one song per value (the best 25 values).
+        If `should_stop()` becomes true partway through, only the values scored so far are returned
+        """
+        normalized_query = normalize_value(query)
+        ngram_index = self.field_ngrams[attr_name]
+        cache_key = (attr_name, frozenset(other_autocomplete_fields.items()))
+        # If they've just typed more since last time, only the last (near-)matches are likely to match.
+        # Otherwise, only score the values that share n-grams with the query, not the whole library
+        narrowed_candidates = self.autocomplete_cache.get(cache_key, normalized_query)
+
+        # The other fields narrow it down to a few songs, so only their values need checking
+        allowed_rows_by_value = None
+        if other_autocomplete_fields:
+            allowed_rows_by_value = defaultdict(list)
+            for row in self._autocomplete_filtered_from_other_fields(other_autocomplete_fields, should_stop):
+                allowed_rows_by_value[self.store.value(attr_name, row)].append(row)
+
+        def search(candidates: Iterable[str]) -> Tuple[TopK[Sequence[int]], Set[str], bool]:
+            if allowed_rows_by_value is not None:
+                candidates = [value for value in allowed_rows_by_value if value in candidates]
+            return self._score_autocomplete_candidates(normalized_query, attr_name, candidates,
+                                                       allowed_rows_by_value, should_stop)
+
+        if narrowed_candidates is not None:
+            (best, near_matches, scored_all) = search(narrowed_candidates)
+            # Narrowing's only a guess: `partial_ratio` can go up as the query gets longer,
+            # so values that weren't close last time might match now. If there's room for more, look properly
+            if len(best) < DISCORD_AUTOCOMPLETE_LIMIT and not should_stop():
+                narrowed_candidates = None
+        if narrowed_candidates is None:
+            (best, near_matches, scored_all) = search(ngram_index.candidates(normalized_query, should_stop))
+        # Unscored values might've matched, so a cut-short search can't be re-used
+        if scored_all:
+            self.autocomplete_cache.store(cache_key, normalized_query, near_matches)
+        # Every song with a value shows up the same, so one song per value's enough
+        return (self.store.song(rows[0]) for (_rank, _value, rows) in best.best_first())
+
+    def _score_autocomplete_candidates(self, normalized_query: str, attr_name: str, candidates: Iterable[str],
+                                       allowed_rows_by_value: Optional[Dict[str, List[int]]],
+                                       should_stop: Callable[[], bool]) -> Tuple[TopK[Sequence[int]], Set[str], bool]:
+        """
+        The best 25 of `candidates`, the values that (nearly) matched, for the autocomplete cache,
+        and whether every candidate got scored (so those are all of them)
+        """
+        ngram_index = self.field_ngrams[attr_name]
+        table = self.store.tables[attr_name]
+        # Ranked by highest confidence, then by string length similarity
         # e.g. Searching for "ain't" will put "Ain't" at the top,
         #      and "Two Out Of Three Ain't Bad" lower
-        possible_songs.sort(key=lambda kv: (kv[1], len(get_tag(kv[0])) - len(query)))
-        # Return without the confidence value
-        return (song for (song, _conf) in possible_songs)
+        best: TopK[Sequence[int]] = TopK(DISCORD_AUTOCOMPLETE_LIMIT)
+        near_matches = set()
+        # If it's already time to stop, the candidates might've been cut short too
+        scored_all = not should_stop()
+
+        def score_candidates() -> Iterator[Tuple[Rank, str, Sequence[int]]]:
+            nonlocal scored_all
+            for (i, value) in enumerate(candidates):
+                if i % AUTOCOMPLETE_CHECK_INTERVAL == 0 and should_stop():
+                    scored_all = False
+                    return
+                normalized = ngram_index.normalized(value)
+                # If the `query` is longer than the searched field, don't consider it.
+                # This is so searching for, e.g., "Mezzanine" doesn't cause "Me" to show up
+                if len(normalized_query) > len(normalized):
+                    continue
+                length_difference = len(normalized) - len(normalized_query)
+                worst_rank = best.worst_rank()
+                if worst_rank is not None:
+                    # Full of perfect, same-length matches: nothing else can get in
+                    if worst_rank >= (100, 0):
+                        scored_all = False
+                        return
+                    # Even a perfect match this long wouldn't get in, so don't bother scoring it
+                    if worst_rank >= (100, -length_difference):
+                        scored_all = False
+                        continue
+                # Same scorer as `score_column`. Gives 0 as soon as it can't reach the cutoff
+                confidence = fuzz.partial_ratio(normalized_query, normalized,
+                                                score_cutoff=AUTOCOMPLETE_MIN_SIMILARITY - AUTOCOMPLETE_CACHE_SLACK)
+                if not confidence:
+                    continue
+                near_matches.add(value)
+                if confidence < AUTOCOMPLETE_MIN_SIMILARITY:
+                    continue
+                if allowed_rows_by_value is not None:
+                    rows = allowed_rows_by_value[value]
+                else:
+                    rows = self.store.rows_with_value[attr_name][table.id_of(value)]
+                if rows:
+                    yield ((confidence, -length_difference), value, rows)
 
-    def _autocomplete_filtered_from_other_fields(self, other_autocomplete_fields: Dict[str, str]) -> Set[SongData]:
+        for (rank, value, rows) in score_candidates():
+            best.push(rank, value, rows)
+        return (best, near_matches, scored_all)
+
+    def _autocomplete_filtered_from_other_fields(self, other_autocomplete_fields: Dict[str, str],
+                                                 should_stop: Callable[[], bool] = lambda: False) -> Sequence[int]:
+        """The (sorted) rows of every song matching all of the other fields"""
         # If no other autocomplete fields exist, just search everything
         if len(other_autocomplete_fields) == 0:
-            return self.all_songs
-        # Using an iterator, so our first value can "populate" the set
-        it = iter(other_autocomplete_fields.items())
-        (name, value) = next(it)
-        possible_songs = self.field_to_song[name][value]
-        # ... then use the remaining fields to filter
-        for (name, value) in it:
-            possible_songs.intersection_update(self.field_to_song[name][value])
-        return possible_songs
+            return sorted(self.store.rows())
+        return intersect_sorted(*(
+            self.store.rows_with(name, value) for (name, value) in other_autocomplete_fields.items()
+        ), should_stop=should_stop)
+
+    def _search_autocomplete(self, query: str, attr_name: str, other_autocomplete_fields: Dict[str, str],
+                             should_stop: Callable[[], bool]) -> List[str]:
+        """
+        The values to suggest for this field. Runs in an autocomplete thread.
+
+        Gives up early, with the best values found so far, once `should_stop()` is true,
+        or if the library needs changing
+        """
+        def stop_searching() -> bool:
+            return self._index_lock.writers_waiting > 0 or should_stop()
+
+        with self._index_lock.reading():
+            # * IF: someone's typed into the field, return the most likely values
+            if query.strip():
+                possible_songs = self._autocomplete_give_closest_match(
+                    query, attr_name, other_autocomplete_fields, stop_searching
+                )
+                # We only wanna see data from the current field
+                possible_values = map(lambda s: getattr(s, attr_name), possible_songs)
+            else:
+                possible_rows = self._autocomplete_filtered_from_other_fields(other_autocomplete_fields,
+                                                                              stop_searching)
+                # * If album's been set, return in track-number order
+                # * (So the `title` field shows 1st, 2nd, 3rd... songs in order)
+                if attr_name == "title" and other_autocomplete_fields.get('album'):
+                    allowed_rows = set(possible_rows)
+                    possible_values = (self.store.value(attr_name, row)
+                                       for row in self._album_rows(other_autocomplete_fields['album'])
+                                       if row in allowed_rows)
+                # * Otherwise, the first values alphabetically.
+                # * Only each row's value is looked up, rather than sorting every song
+                else:
+                    values = set()
+                    for (i, row) in enumerate(possible_rows):
+                        if i % AUTOCOMPLETE_CHECK_INTERVAL == 0 and stop_searching():
+                            break
+                        values.add(self.store.value(attr_name, row))
+                    possible_values = heapq.nsmallest(DISCORD_AUTOCOMPLETE_LIMIT, values)
+            # Return 25 (the API limit) non-duplicating values
+            # (Non-duplicating, because every song in an album adds the same album name)
+            return list(get_x_unique_values(possible_values, DISCORD_AUTOCOMPLETE_LIMIT))
 
     def get_autocomplete_suggestions(self, attr_name):
         async def inner(
@@ -235,34 +684,37 @@ class LocalAudioLibrary:
                 possible_songs = self._autocomplete_give_random_values(attr_name)
                 return (discord.app_commands.Choice(name=name, value=name)
                         for name in possible_songs[:DISCORD_AUTOCOMPLETE_LIMIT])
-            # * IF: someone's typed into the field, return the most likely values
-            elif query.strip():
-                possible_songs = self._autocomplete_give_closest_match(query, attr_name, other_autocomplete_fields)
-            else:
-                possible_songs = self._autocomplete_filtered_from_other_fields(other_autocomplete_fields)
-                # * If album's been set, return in track-number order
-                # * (So the `title` field shows 1st, 2nd, 3rd... songs in order)
-                if attr_name == "title" and other_autocomplete_fields.get('album'):
-                    possible_songs = sorted(possible_songs)
-                # * Otherwise, sort by the current field
-                else:
-                    possible_songs = sorted(possible_songs, key=lambda s: getattr(s, attr_name))
-            # We only wanna see data from the current field
-            possible_songs = map(lambda s: getattr(s, attr_name), possible_songs)
-            # Return 25 (the API limit) non-duplicating values
-            # (Non-duplicating, because every song in an album adds the same album name)
-            return (
-                discord.app_commands.Choice(name=name, value=name)
-                for name in get_x_unique_values(possible_songs, DISCORD_AUTOCOMPLETE_LIMIT)
-            )
 
-        return inner
+            # Their last keystroke's suggestions aren't needed anymore
+            cancelled = threading.Event()
+            previous = self._autocomplete_requests.get(interaction.user.id)
+            if previous is not None:
+                previous.set()
+            self._autocomplete_requests[interaction.user.id] = cancelled
+            deadline = time.monotonic() + AUTOCOMPLETE_DEADLINE_SECONDS
+
+            def should_stop() -> bool:
+                return cancelled.is_set() or time.monotonic() >= deadline
+
+            try:
+                names = await asyncio.get_running_loop().run_in_executor(
+                    self._autocomplete_executor,
+                    self._search_autocomplete, query, attr_name, other_autocomplete_fields, should_stop,
+                )
+            finally:
+                if self._autocomplete_requests.get(interaction.user.id) is cancelled:
+                    del self._autocomplete_requests[interaction.user.id]
+            if cancelled.is_set():
+                return []
+            return (discord.app_commands.Choice(name=name, value=name) for name in names)
 
+        return inner
 
 if __name__ == "__main__":
     # Debugging script, consider removing
     import pickle
-    local_library = LocalAudioLibrary("src")
+    local_library = LocalAudioLibrary(["src"])
+    asyncio.run(local_library.load())
     with open("all_songs.pkl", "rb") as file:
         all_songs: List[SongData] = pickle.load(file)
     new_songs = [SongData(
@@ -276,6 +728,6 @@ if __name__ == "__main__":
         for song in all_songs
     ]
     
-    local_library.all_songs = new_songs
+    local_library.apply_changes(new_songs, removed=[])
     x = local_library._autocomplete_give_closest_match(query="Mouth", attr_name="album", other_autocomplete_fields={})
     print(x)
@@ -0,0 +1,164 @@
+"""
+A list that stays fast to index, insert into and delete from, even with hundreds of thousands of items.
+
+Used for song queues, where a plain list (or deque) makes every `remove`/`move`/page O(n).
+"""
+import random
+from itertools import chain, islice
+from typing import Generic, Iterable, Iterator, List, Tuple, TypeVar, Union, overload
+
+CHUNK_SIZE = 256    # Chunks are split when they get twice this big
+
+T = TypeVar("T")
+
+
+class IndexedList(Generic[T]):
+    """
+    The items are kept in chunks of up to `2 * CHUNK_SIZE`, with a Fenwick tree of the chunks' sizes.
+
+    Finding position `i` walks the tree (O(log n)), then inserting/deleting there only shifts one chunk.
+    Reading a page of `k` items from position `i` is O(log n + k).
+    """
+
+    def __init__(self, items: Iterable[T] = ()):
+        self._chunks: List[List[T]] = []
+        self._tree: List[int] = []
+        self._len = 0
+        self.extend(items)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[T]:
+        return chain.from_iterable(self._chunks)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)!r})"
+
+    # ----- The Fenwick tree of chunk sizes -----
+    def _rebuild_tree(self):
+        """O(number of chunks). Only needed when chunks are added or removed"""
+        tree = [len(chunk) for chunk in self._chunks]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _grow_chunk(self, chunk_index: int, delta: int):
+        while chunk_index < len(self._tree):
+            self._tree[chunk_index] += delta
+            chunk_index |= chunk_index + 1
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        """Which chunk position `index` (0 <= index < len) is in, and where in that chunk"""
+        chunk_index = -1
+        step = 1 << (len(self._tree).bit_length() - 1) if self._tree else 0
+        while step:
+            child = chunk_index + step
+            if child < len(self._tree) and self._tree[child] <= index:
+                chunk_index = child
+                index -= self._tree[child]
+            step >>= 1
+        return (chunk_index + 1, index)
+
+    def _normalize_index(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("list index out of range")
+        return index
+
+    # ----- Reading -----
+    @overload
+    def __getitem__(self, index: int) -> T: ...
+    @overload
+    def __getitem__(self, index: slice) -> List[T]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[T, List[T]]:
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            return list(islice(self._iter_from(start), max(0, stop - start)))
+        (chunk_index, offset) = self._locate(self._normalize_index(index))
+        return self._chunks[chunk_index][offset]
+
+    def _iter_from(self, start: int) -> Iterator[T]:
+        if start >= self._len:
+            return
+        (chunk_index, offset) = self._locate(start)
+        yield from islice(self._chunks[chunk_index], offset, None)
+        for chunk in islice(self._chunks, chunk_index + 1, None):
+            yield from chunk
+
+    # ----- Changing -----
+    def append(self, item: T):
+        if self._chunks and len(self._chunks[-1]) < 2 * CHUNK_SIZE:
+            self._chunks[-1].append(item)
+            self._grow_chunk(len(self._chunks) - 1, 1)
+        else:
+            self._chunks.append([item])
+            self._rebuild_tree()
+        self._len += 1
+
+    def extend(self, items: Iterable[T]):
+        """Adds every item to the end, then updates the index once"""
+        items = list(items)
+        if not items:
+            return
+        position = 0
+        if self._chunks:
+            # Top up the last chunk first
+            position = max(0, 2 * CHUNK_SIZE - len(self._chunks[-1]))
+            self._chunks[-1].extend(items[:position])
+        for start in range(position, len(items), CHUNK_SIZE):
+            self._chunks.append(items[start:start + CHUNK_SIZE])
+        self._len += len(items)
+        self._rebuild_tree()
+
+    def insert(self, index: int, item: T):
+        """Inserts before `index`. Like `list.insert`, out-of-range indexes go at the start/end"""
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            self.append(item)
+            return
+        (chunk_index, offset) = self._locate(index)
+        chunk = self._chunks[chunk_index]
+        chunk.insert(offset, item)
+        self._len += 1
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[chunk_index:chunk_index + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._rebuild_tree()
+        else:
+            self._grow_chunk(chunk_index, 1)
+
+    def pop(self, index: int = -1) -> T:
+        (chunk_index, offset) = self._locate(self._normalize_index(index))
+        chunk = self._chunks[chunk_index]
+        item = chunk.pop(offset)
+        self._len -= 1
+        if chunk:
+            self._grow_chunk(chunk_index, -1)
+        else:
+            del self._chunks[chunk_index]
+            self._rebuild_tree()
+        return item
+
+    def popleft(self) -> T:
+        return self.pop(0)
+
+    def __delitem__(self, index: int):
+        self.pop(index)
+
+    def clear(self):
+        self._chunks.clear()
+        self._tree.clear()
+        self._len = 0
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self.clear()
+        self.extend(items)
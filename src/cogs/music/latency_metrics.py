@@ -0,0 +1,216 @@
+"""
+Histograms of how long each step of playing a song takes, per server.
+
+The steps, in the order they happen:
+- `extract`: yt-dlp looking up what was asked for (`YTDLSource.from_query`)
+- `stream_extract`: yt-dlp looking up a song's streams, right before it plays (`YTDLSource.generate_source`)
+- `url_selection`: picking which of those streams to play
+- `transcode_wait`: waiting for a free ffmpeg slot (see `transcode_scheduler`)
+- `ffmpeg_spawn`: starting ffmpeg
+- `first_packet`: from handing the song to discord.py, to ffmpeg giving it the first bit of audio
+- `command_to_first_audio`: from the `play` command, to the first bit of audio (only when nothing was playing)
+- `track_gap`: the silence between one song ending and the next starting
+
+They can be served to Prometheus (or anything that reads its format) on `METRICS_PORT`,
+and/or summarised in the log every `METRICS_LOG_SECONDS`.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+import discord
+from aiohttp import web
+
+# Upper bounds of each bucket, in seconds. Anything slower goes in the last (+Inf) bucket
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRIC_NAME = "music_stage_latency_seconds"
+
+logger = logging.getLogger(__name__)
+
+# The server whose song is being worked on, for stages that don't otherwise know it (e.g. `generate_source`)
+current_guild: "contextvars.ContextVar[Optional[Hashable]]" = contextvars.ContextVar("current_guild", default=None)
+
+
+class Histogram:
+    """How many observations fell into each of `BUCKETS`, plus their count and total"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.bucket_counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def merge(self, other: "Histogram"):
+        for (i, bucket_count) in enumerate(other.bucket_counts):
+            self.bucket_counts[i] += bucket_count
+        self.count += other.count
+        self.total += other.total
+
+    def quantile(self, q: float) -> float:
+        """Roughly the `q`th quantile: the upper bound of the bucket it's in"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for (upper_bound, bucket_count) in zip(BUCKETS, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return upper_bound
+        return float("inf")
+
+
+class LatencyMetrics:
+    """Every stage's histogram, per server. Can be added to from any thread"""
+
+    def __init__(self):
+        # (stage, server) -> its histogram
+        self._histograms: Dict[Tuple[str, Hashable], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, guild: Optional[Hashable] = None):
+        """Records that `stage` took `seconds`. If `guild` isn't given, it's `current_guild`"""
+        if guild is None:
+            guild = current_guild.get()
+        with self._lock:
+            histogram = self._histograms.get((stage, guild))
+            if histogram is None:
+                histogram = self._histograms[(stage, guild)] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, stage: str, guild: Optional[Hashable] = None) -> Iterator[None]:
+        """Records how long the `with` block took (if it didn't raise)"""
+        start = time.monotonic()
+        yield
+        self.observe(stage, time.monotonic() - start, guild)
+
+    def forget_guild(self, guild: Hashable):
+        """
+        Drops the server's histograms (e.g. once the bot's left it), so they don't pile up forever.
+        They're added to the histograms without a server, so the totals across every server don't change
+        """
+        if guild is None:
+            return
+        with self._lock:
+            for key in [key for key in self._histograms if key[1] == guild]:
+                histogram = self._histograms.pop(key)
+                self._histograms.setdefault((key[0], None), Histogram()).merge(histogram)
+
+    def by_stage(self) -> Dict[str, Histogram]:
+        """Each stage's histogram, with every server's added together"""
+        totals: Dict[str, Histogram] = {}
+        with self._lock:
+            for ((stage, _), histogram) in self._histograms.items():
+                totals.setdefault(stage, Histogram()).merge(histogram)
+        return totals
+
+    def prometheus_text(self) -> str:
+        """Every histogram, in Prometheus' text format"""
+        lines = [f"# HELP {METRIC_NAME} How long each step of playing a song took",
+                 f"# TYPE {METRIC_NAME} histogram"]
+        with self._lock:
+            items = sorted(self._histograms.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            for ((stage, guild), histogram) in items:
+                labels = f'stage="{stage}",guild="{guild if guild is not None else ""}"'
+                cumulative = 0
+                for (upper_bound, bucket_count) in zip(BUCKETS + ("+Inf",), histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+                lines.append(f"{METRIC_NAME}_sum{{{labels}}} {histogram.total}")
+                lines.append(f"{METRIC_NAME}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """One line per stage, e.g. for the log"""
+        lines = []
+        for (stage, histogram) in sorted(self.by_stage().items()):
+            lines.append(f"{stage}: n={histogram.count}, mean={histogram.total / histogram.count * 1000:.0f}ms, "
+                         f"p50<={histogram.quantile(0.5) * 1000:.0f}ms, p95<={histogram.quantile(0.95) * 1000:.0f}ms")
+        return "\n".join(lines)
+
+
+class FirstPacketTimer(discord.AudioSource):
+    """
+    Passes audio through from `source`, recording how long it took to give its first bit of audio.
+    discord.py reads it from its own thread, which is why `LatencyMetrics` has a lock
+    """
+
+    def __init__(self, source: discord.AudioSource, stages: List[Tuple[str, float]], guild: Hashable):
+        """`stages` are (stage, when it started), each recorded once the first audio's read"""
+        self.source = source
+        self._stages = stages
+        self._guild = guild
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if self._stages:
+            now = time.monotonic()
+            for (stage, started_at) in self._stages:
+                latency_metrics.observe(stage, now - started_at, self._guild)
+            self._stages = []
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+class MetricsReporter:
+    """Serves the metrics on `METRICS_PORT` and/or logs a summary every `METRICS_LOG_SECONDS`, if they're set"""
+
+    def __init__(self, metrics: LatencyMetrics):
+        self.metrics = metrics
+        # Anything else to serve alongside the latencies, each giving Prometheus' text format
+        self._extra_sources: List[Callable[[], str]] = []
+        self._runner: Optional[web.AppRunner] = None
+        self._logger_task: Optional[asyncio.Task] = None
+
+    def add_source(self, source: Callable[[], str]):
+        self._extra_sources.append(source)
+
+    async def start(self):
+        port = os.environ.get("METRICS_PORT")
+        if port:
+            app = web.Application()
+            app.router.add_get("/metrics", self._serve_metrics)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            # Only reachable from this machine
+            await web.TCPSite(self._runner, "127.0.0.1", int(port)).start()
+            logger.info(f"Serving latency metrics on http://127.0.0.1:{port}/metrics")
+        log_seconds = os.environ.get("METRICS_LOG_SECONDS")
+        if log_seconds:
+            self._logger_task = asyncio.get_running_loop().create_task(self._log_periodically(float(log_seconds)))
+
+    async def _serve_metrics(self, request: web.Request) -> web.Response:
+        text = "".join([self.metrics.prometheus_text()] + [source() for source in self._extra_sources])
+        return web.Response(text=text, content_type="text/plain")
+
+    async def _log_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            summary = self.metrics.summary()
+            if summary:
+                logger.info("Latency so far:\n%s", summary)
+
+    async def stop(self):
+        if self._logger_task is not None:
+            self._logger_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# Every stage's recorded here
+latency_metrics = LatencyMetrics()
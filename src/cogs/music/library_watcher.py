@@ -0,0 +1,204 @@
+"""
+Keeps a LocalAudioLibrary up to date as files in its music folders change.
+
+Uses `watchdog` (inotify on Linux) if it's installed, otherwise the folders are re-scanned every so often.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from .find_local_audio import LocalAudioLibrary, get_song_data
+from .song_data import SongData
+from .tag_cache import TagCache, walk_music_folder
+
+try:
+    from watchdog.events import FileSystemEvent, FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+BATCH_QUIET_SECONDS = 2         # Changes are applied once the folder's been quiet for this long...
+BATCH_MAX_WAIT_SECONDS = 30     # ...or once they've been waiting this long, whichever's first
+POLL_INTERVAL_SECONDS = 60      # How often the folder's re-scanned without watchdog
+
+logger = logging.getLogger(__name__)
+
+
+if Observer is not None:
+    class _ChangeHandler(FileSystemEventHandler):
+        def __init__(self, watcher: "LibraryWatcher"):
+            self.watcher = watcher
+
+        def on_any_event(self, event: FileSystemEvent):
+            if event.event_type not in ("created", "deleted", "modified", "moved"):
+                return
+            # A folder is "modified" whenever a file inside it changes, which we'll already hear about
+            if event.is_directory and event.event_type == "modified":
+                return
+            self.watcher.notify(event.src_path)
+            if getattr(event, "dest_path", None):
+                self.watcher.notify(event.dest_path)
+
+
+class LibraryWatcher:
+    """
+    Watches the library's folders, and applies any added/removed/re-tagged songs to it.
+
+    Changes are batched, so copying in a whole album only updates the library once.
+    """
+
+    def __init__(self, library: LocalAudioLibrary):
+        self.library = library
+        self._pending: Set[str] = set()
+        self._changed: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []
+        self._observer = None
+
+    def start(self):
+        """Gets ready to watch folders (see `watch()`). Must be called from within the event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.start()
+        self._tasks.append(self._loop.create_task(self._apply_batches()))
+
+    def watch(self, folder: str):
+        """Starts watching one of the library's folders. Call it once that folder's been scanned"""
+        if self._observer is not None:
+            self._observer.schedule(_ChangeHandler(self), folder, recursive=True)
+            logger.info(f"Watching {folder} for changes")
+        else:
+            self._tasks.append(self._loop.create_task(self._poll_for_changes(folder)))
+            logger.info(f"`watchdog` isn't installed, checking {folder} "
+                        f"for changes every {POLL_INTERVAL_SECONDS}s")
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    def notify(self, path: str):
+        """Marks `path` as changed. Safe to call from any thread"""
+        self._loop.call_soon_threadsafe(self._add_pending, path)
+
+    def _add_pending(self, path: str):
+        self._pending.add(path)
+        self._changed.set()
+
+    async def _poll_for_changes(self, folder: str):
+        loop = asyncio.get_running_loop()
+        take_snapshot = lambda: {path: (size, mtime_ns)
+                                 for (path, size, mtime_ns) in walk_music_folder(folder)}
+        previous: Dict[str, Tuple[int, int]] = await loop.run_in_executor(None, take_snapshot)
+        while True:
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+            current = await loop.run_in_executor(None, take_snapshot)
+            for path in current.keys() | previous.keys():
+                if current.get(path) != previous.get(path):
+                    self._add_pending(path)
+            previous = current
+
+    async def _apply_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._changed.wait()
+            # Wait for the changes to settle down (e.g. a big album finishing copying)
+            deadline = loop.time() + BATCH_MAX_WAIT_SECONDS
+            while True:
+                self._changed.clear()
+                time_left = deadline - loop.time()
+                if time_left <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=min(BATCH_QUIET_SECONDS, time_left))
+                except asyncio.TimeoutError:
+                    break
+            self._changed.clear()
+
+            batch, self._pending = self._pending, set()
+            try:
+                (updated, removed, retry) = await loop.run_in_executor(None, self._read_changes, batch)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if retry:
+                # Their tags couldn't be saved, so they still look changed. Try again with the next batch
+                for path in retry:
+                    self._add_pending(path)
+            if updated or removed:
+                await self.library.apply_changes_without_blocking(updated, removed)
+                logger.info(f"Library updated: {len(updated)} song(s) added/changed, {len(removed)} removed")
+
+    def _read_changes(self, paths: Set[str]) -> Tuple[List[SongData], List[str], Set[str]]:
+        """
+        Re-reads the changed paths. Run in a worker thread, as parsing is slow.
+        Also returns the paths to try again, because their folder's tag cache couldn't be saved
+        """
+        updated: List[SongData] = []
+        removed: List[str] = []
+        files: Dict[str, Tuple[int, int]] = {}
+        changed_caches: Set[TagCache] = set()
+        for path in paths:
+            cache = self.library.tag_cache_for(path)
+            if cache is None:
+                continue
+            changed_caches.add(cache)
+            if os.path.isdir(path):
+                # A whole folder was moved in
+                files.update((p, (size, mtime_ns)) for (p, size, mtime_ns) in walk_music_folder(path))
+                continue
+            try:
+                stat = os.stat(path) if os.path.isfile(path) else None
+            except OSError:
+                # Deleted since it was checked
+                stat = None
+            if stat is not None:
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+            else:
+                # Deleted, or moved out. Could've been a whole folder
+                self._forget_path(cache, path, removed)
+
+        for (path, (size, mtime_ns)) in files.items():
+            cache = self.library.tag_cache_for(path)
+            if cache.is_fresh(path, size, mtime_ns):
+                continue
+            if not os.path.exists(path):
+                # Deleted while the batch was being read
+                self._forget_path(cache, path, removed)
+                continue
+            song = get_song_data(path)
+            cache.update(path, size, mtime_ns, song)
+            if song is not None:
+                updated.append(song)
+            elif self.library.get_song(path) is not None:
+                # It used to be a song, but can't be read anymore
+                removed.append(path)
+        failed_caches: Set[TagCache] = set()
+        for cache in changed_caches:
+            try:
+                cache.commit()
+            except Exception as e:
+                logger.warning(f"Couldn't save the tag cache for {cache.folder}, will try again: {e!r}")
+                failed_caches.add(cache)
+        if not failed_caches:
+            return (updated, removed, set())
+        # Not applied to the library until they're saved, or they'd be re-read (and re-applied) on restart
+        in_failed_cache = lambda path: self.library.tag_cache_for(path) in failed_caches
+        return ([song for song in updated if not in_failed_cache(song.filepath)],
+                [path for path in removed if not in_failed_cache(path)],
+                {path for path in paths if in_failed_cache(path)})
+
+    def _forget_path(self, cache: TagCache, path: str, removed: List[str]):
+        """Removes a deleted file (or every file in a deleted folder) from the tag cache"""
+        gone = [path] if path in cache else cache.paths_under(path)
+        for gone_path in gone:
+            if self.library.get_song(gone_path) is not None:
+                removed.append(gone_path)
+            cache.remove(gone_path)
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from sys import stderr
+from typing import Optional, Set, Tuple
 
-from discord import FFmpegPCMAudio, Embed, Colour, User
+from discord import AudioSource, FFmpegOpusAudio, FFmpegPCMAudio, Embed, Colour, User
 
 from src.cogs.music.find_local_audio import SongData
 
 from .abstract_audio import AbstractAudio
+from .latency_metrics import latency_metrics
+from .opus_cache import OpusCache
 
 FFMPEG_OPTIONS = {
     "options": "-vn",
@@ -20,12 +23,26 @@ class LocalAudioSource(AbstractAudio):
     An audio source for local music files.
     """
 
-    def __init__(self, song_data: SongData, added_by: User):
+    def __init__(self, song_data: SongData, added_by: User, opus_cache: Optional[OpusCache] = None,
+                 counted_plays: Optional[Set[Tuple[str, str]]] = None):
         self.song_data = song_data
         self.requester = added_by
+        self.opus_cache = opus_cache
+        # (field, value)s already counted as played (see `LocalAudioLibrary.record_play`).
+        # Shared by songs queued together, so playing a whole album only counts the album once
+        self.counted_plays: Set[Tuple[str, str]] = counted_plays if counted_plays is not None else set()
 
-    async def generate_source(self) -> FFmpegPCMAudio:
-        return FFmpegPCMAudio(self.song_data.filepath, **FFMPEG_OPTIONS)
+    async def generate_source(self) -> AudioSource:
+        if self.opus_cache is not None:
+            cached_path = self.opus_cache.get(self.song_data.filepath)
+            # Already Opus, so it can be sent as-is
+            if cached_path is not None:
+                with latency_metrics.timed("ffmpeg_spawn"):
+                    return FFmpegOpusAudio(cached_path, codec="copy", **FFMPEG_OPTIONS)
+            # Not cached yet, so it'll be ready next time
+            self.opus_cache.request(self.song_data.filepath)
+        with latency_metrics.timed("ffmpeg_spawn"):
+            return FFmpegPCMAudio(self.song_data.filepath, **FFMPEG_OPTIONS)
 
     def create_embed(self) -> Embed:
         track_num = self.song_data.track_num
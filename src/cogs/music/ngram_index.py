@@ -0,0 +1,86 @@
+"""
+An inverted index from n-grams (3-letter chunks) to the tag values that contain them.
+
+Used to shortlist which values are worth fuzzy-matching, instead of fuzzy-matching every song.
+"""
+from collections import Counter, defaultdict
+from math import ceil
+from typing import Callable, Dict, Optional, Set
+
+from .normalize import normalize_value
+
+NGRAM_SIZE = 3
+MIN_SHARED_NGRAMS = 0.4     # A value must contain 40% of the query's n-grams to be shortlisted
+STOP_CHECK_INTERVAL = 256   # How many n-grams are looked through between checking if a search should give up
+
+
+def get_ngrams(text: str) -> Set[str]:
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+class NGramIndex:
+    """Maps every n-gram to the (distinct) tag values that contain it"""
+
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        self._normalized: Dict[str, str] = {}
+        # Values too short to have any n-grams
+        self._short_values: Set[str] = set()
+
+    def __len__(self):
+        return len(self._normalized)
+
+    def add(self, value: str, normalized: Optional[str] = None):
+        """Indexes `value`. Pass its `normalized` form if it's already been worked out"""
+        if value in self._normalized:
+            return
+        if normalized is None:
+            normalized = normalize_value(value)
+        self._normalized[value] = normalized
+        if len(normalized) < NGRAM_SIZE:
+            self._short_values.add(value)
+        for ngram in get_ngrams(normalized):
+            self._postings[ngram].add(value)
+
+    def remove(self, value: str):
+        normalized = self._normalized.pop(value, None)
+        if normalized is None:
+            return
+        self._short_values.discard(value)
+        for ngram in get_ngrams(normalized):
+            values = self._postings[ngram]
+            values.discard(value)
+            if not values:
+                del self._postings[ngram]
+
+    def normalized(self, value: str) -> str:
+        return self._normalized[value]
+
+    def candidates(self, normalized_query: str, should_stop: Callable[[], bool] = lambda: False) -> Set[str]:
+        """
+        The values that might fuzzy-match the (already normalized) query.
+
+        This only looks at values sharing n-grams with the query,
+        so it's as slow as the number of matches, not the size of the library.
+        If `should_stop()` becomes true partway through, only the values found so far are returned
+        """
+        query_ngrams = get_ngrams(normalized_query)
+        # Too short to have any n-grams: find every n-gram containing it instead
+        if not query_ngrams:
+            matches = set()
+            for (i, (ngram, values)) in enumerate(self._postings.items()):
+                if i % STOP_CHECK_INTERVAL == 0 and should_stop():
+                    return matches
+                if normalized_query in ngram:
+                    matches.update(values)
+            matches.update(value for value in self._short_values
+                           if normalized_query in self._normalized[value])
+            return matches
+
+        shared_ngrams = Counter()
+        for ngram in query_ngrams:
+            if should_stop():
+                break
+            shared_ngrams.update(self._postings.get(ngram, ()))
+        min_shared = max(1, ceil(len(query_ngrams) * MIN_SHARED_NGRAMS))
+        return {value for (value, n_shared) in shared_ngrams.items() if n_shared >= min_shared}
@@ -0,0 +1,26 @@
+"""
+Turns tag values (and queries) into the keys that actually get searched
+"""
+import re
+import unicodedata
+
+_PUNCTUATION_AND_SPACES = re.compile(r"[\W_]+")
+# Letters that aren't "letter + accent", so NFKD leaves them alone
+_UNACCENTED_LETTERS = str.maketrans({
+    "æ": "ae", "œ": "oe", "ø": "o", "ð": "d", "đ": "d", "þ": "th", "ł": "l", "ı": "i",
+})
+
+
+def normalize_value(value: str) -> str:
+    """
+    What's actually indexed/searched, so "Beyoncé", "BEYONCE" and "Ｂｅｙｏｎｃｅ" all match "beyonce".
+
+    Case and accents are removed, full-width letters become normal ones,
+    and runs of punctuation/whitespace become a single space.
+    """
+    # NFKD splits "é" into "e" + an accent, and turns "Ｂ" into "B"
+    decomposed = unicodedata.normalize("NFKD", value.casefold()).translate(_UNACCENTED_LETTERS)
+    without_accents = "".join(char for char in decomposed if not unicodedata.combining(char))
+    normalized = _PUNCTUATION_AND_SPACES.sub(" ", without_accents).strip()
+    # Something like "!!!" is nothing but punctuation, so keep it as-is (otherwise it can't be searched)
+    return normalized or value.casefold()
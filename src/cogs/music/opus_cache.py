@@ -0,0 +1,175 @@
+"""
+An optional on-disk cache of local songs, pre-encoded as Opus.
+
+Discord only accepts Opus, so playing an uncached song means ffmpeg decoding it to PCM,
+then discord.py re-encoding that to Opus. Cached songs are already Opus, so ffmpeg just copies them.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from subprocess import DEVNULL, PIPE
+from typing import Dict, Optional
+
+from .transcode_scheduler import get_transcode_scheduler
+
+DEFAULT_MAX_MB = 2048       # How big the cache can get, unless `OPUS_CACHE_MAX_MB` says otherwise
+ENCODE_BITRATE = "128k"     # The same as discord.py uses when it encodes
+ENCODE_CONCURRENCY = 1      # Songs encoded at once, so the cache doesn't compete with songs being played
+TRANSCODE_SCHEDULER_KEY = "opus-cache"  # Takes its turn for ffmpeg slots like a server does
+MAX_PENDING_ENCODES = 8     # Songs waiting to be encoded. Any more requests are ignored until there's room
+LOOKAHEAD_SONGS = 3         # How many of a queue's next songs are cached while the current one plays
+
+logger = logging.getLogger(__name__)
+
+
+class OpusCache:
+    """
+    48 kHz Opus (Ogg) encodings of local songs, kept in `folder`, using at most `max_bytes`.
+    When it's full, the least recently played songs are deleted.
+
+    Each file's named after the song's path, size and modified time, so a changed song is encoded again.
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        # filename -> size. The least recently played are at the start
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._encoding: Dict[str, asyncio.Task] = {}
+        self._encode_slots = asyncio.Semaphore(ENCODE_CONCURRENCY)
+        self._load()
+
+    @classmethod
+    def from_env(cls) -> Optional["OpusCache"]:
+        """The cache set up in the .env file, or None if it's not turned on"""
+        folder = os.environ.get("OPUS_CACHE_FOLDER")
+        if not folder:
+            return None
+        max_mb = int(os.environ.get("OPUS_CACHE_MAX_MB") or DEFAULT_MAX_MB)
+        return cls(folder, max_mb * 1024 * 1024)
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith(".part"):
+                # Left over from an encode that was interrupted
+                os.remove(path)
+            elif name.endswith(".opus"):
+                stat = os.stat(path)
+                # Every play touches the file, so its modified time is when it was last played
+                found.append((stat.st_mtime_ns, name, stat.st_size))
+        for (_, name, size) in sorted(found):
+            self._sizes[name] = size
+            self._total_bytes += size
+        self._evict()
+        logger.info(f"Opus cache: {len(self._sizes)} song(s), {self._total_bytes // (1024 * 1024)}MB")
+
+    def _filename(self, filepath: str) -> Optional[str]:
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        key = f"{filepath}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        return hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest() + ".opus"
+
+    def get(self, filepath: str) -> Optional[str]:
+        """The cached encoding of the song at `filepath`, or None if there isn't one"""
+        name = self._filename(filepath)
+        if name is None or name not in self._sizes:
+            return None
+        path = os.path.join(self.folder, name)
+        try:
+            os.utime(path)
+        except OSError:
+            # Deleted by someone else
+            self._total_bytes -= self._sizes.pop(name)
+            return None
+        self._sizes.move_to_end(name)
+        return path
+
+    def request(self, filepath: str):
+        """
+        Encodes the song in the background, unless it's already cached (or being encoded).
+        A cached song counts as just played, so encoding other songs doesn't push it out before it plays
+        """
+        name = self._filename(filepath)
+        if name is None or name in self._encoding:
+            return
+        if name in self._sizes:
+            self._sizes.move_to_end(name)
+            return
+        if len(self._encoding) >= MAX_PENDING_ENCODES:
+            return
+        task = asyncio.get_running_loop().create_task(self._encode(filepath, name))
+        self._encoding[name] = task
+        task.add_done_callback(lambda _: self._encoding.pop(name, None))
+
+    async def _encode(self, filepath: str, name: str):
+        path = os.path.join(self.folder, name)
+        partial_path = path + ".part"
+        async with self._encode_slots:
+            # Counts towards the bot's ffmpeg limit, like a song being played
+            slot = await get_transcode_scheduler().acquire(TRANSCODE_SCHEDULER_KEY)
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", filepath,
+                    "-map", "0:a:0", "-c:a", "libopus", "-b:a", ENCODE_BITRATE, "-ar", "48000", "-ac", "2",
+                    "-f", "ogg", partial_path,
+                    stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+                )
+            except OSError as e:
+                slot.release()
+                logger.warning(f"Couldn't run ffmpeg to cache {filepath!r}: {e!r}")
+                return
+            try:
+                (_, stderr) = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                _remove_quietly(partial_path)
+                raise
+            finally:
+                slot.release()
+        if process.returncode != 0:
+            logger.warning(f"Couldn't encode {filepath!r} for the Opus cache: "
+                           f"{stderr.decode(errors='replace').strip()}")
+            _remove_quietly(partial_path)
+            return
+        try:
+            os.replace(partial_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            # e.g. the folder was cleared out while it was encoding
+            logger.warning(f"Couldn't add {filepath!r} to the Opus cache: {e!r}")
+            _remove_quietly(partial_path)
+            return
+        self._sizes[name] = size
+        self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """Deletes the least recently played songs until the cache fits"""
+        while self._total_bytes > self.max_bytes and self._sizes:
+            (name, size) = self._sizes.popitem(last=False)
+            self._total_bytes -= size
+            _remove_quietly(os.path.join(self.folder, name))
+
+    def close(self):
+        """Stops any encodes that are still running"""
+        for task in list(self._encoding.values()):
+            task.cancel()
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # e.g. on Windows, a file that's being played can't be deleted
+        logger.warning(f"Couldn't delete {path!r} from the Opus cache: {e!r}")
@@ -0,0 +1,207 @@
+"""
+Saves every server's queue to the database in the background, so restarting (or crashing) doesn't lose it.
+
+Songs are saved as references: a YouTube song's URL and title, or a local song's tags and filepath.
+Restoring a queue doesn't look anything up, each song's found again once it's about to play.
+"""
+import asyncio
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass
+from typing import Dict, Hashable, List, Mapping, NamedTuple, Optional
+
+import discord
+from sqlalchemy import delete, insert, select
+
+from ..db import Session
+from ..db.tables import SavedQueue
+from .abstract_audio import AbstractAudio
+from .local_audio_source import LocalAudioSource
+from .opus_cache import OpusCache
+from .song_data import SongData
+from .voice_state import VoiceState
+from .ytdl_source import YTDLSource
+
+SAVE_INTERVAL_SECONDS = 5   # How often changed queues are saved, so a crash loses at most this much
+
+YOUTUBE = "youtube"
+LOCAL = "local"
+# What YTDLSource reads from its data. The formats aren't kept, they're looked up again when it plays
+_YTDL_KEYS = ("id", "title", "duration", "uploader", "uploader_url", "artist",
+              "url", "webpage_url", "original_url")
+
+logger = logging.getLogger(__name__)
+
+
+class SongReference(NamedTuple):
+    """Just enough to find a song again"""
+    kind: str                   # `YOUTUBE` or `LOCAL`
+    requester_id: int
+    data: dict
+
+
+class SavedRequester(NamedTuple):
+    """Stands in for whoever queued a restored song, if they're not in the bot's cache"""
+    id: int
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+@dataclass
+class QueueSnapshot:
+    """A server's queue, as it's saved"""
+    text_channel_id: int
+    voice_channel_id: int
+    loop: bool
+    songs: List[AbstractAudio]  # Starting with the song that's playing
+
+
+@dataclass
+class RestoredQueue:
+    """A server's queue, as it's loaded"""
+    guild_id: int
+    text_channel_id: int
+    voice_channel_id: int
+    loop: bool
+    songs: List[SongReference]
+
+
+def to_reference(audio: AbstractAudio) -> Optional[SongReference]:
+    """The song as a reference, or None if it's a kind of song that can't be saved"""
+    requester_id = audio.requester.id
+    if isinstance(audio, YTDLSource):
+        data = {key: audio.data[key] for key in _YTDL_KEYS if audio.data.get(key) is not None}
+        return SongReference(YOUTUBE, requester_id, data)
+    if isinstance(audio, LocalAudioSource):
+        return SongReference(LOCAL, requester_id, asdict(audio.song_data))
+    return None
+
+
+def from_reference(reference: SongReference, requester: discord.abc.User,
+                   opus_cache: Optional[OpusCache] = None) -> Optional[AbstractAudio]:
+    """The song again. Nothing's looked up until its source is generated"""
+    if reference.kind == YOUTUBE:
+        return YTDLSource(reference.data, requester)
+    if reference.kind == LOCAL:
+        return LocalAudioSource(SongData(**reference.data), requester, opus_cache)
+    logger.warning(f"Can't restore a saved song of kind {reference.kind!r}, skipping it")
+    return None
+
+
+def save_queues(changes: Dict[int, Optional[QueueSnapshot]]):
+    """Saves each server's queue (or deletes it, if it's None), all in one transaction"""
+    with Session() as session:
+        for (guild_id, snapshot) in changes.items():
+            session.execute(delete(SavedQueue).where(SavedQueue.guild_id == guild_id))
+            if snapshot is None:
+                continue
+            # One row per queue, rather than per song, so saving a queue of thousands of songs is quick
+            references = [reference for reference in map(to_reference, snapshot.songs) if reference is not None]
+            session.execute(insert(SavedQueue).values(
+                guild_id=guild_id,
+                text_channel_id=snapshot.text_channel_id,
+                voice_channel_id=snapshot.voice_channel_id,
+                loop=snapshot.loop,
+                songs=json.dumps(references, separators=(",", ":")),
+            ))
+        session.commit()
+
+
+def load_queues() -> List[RestoredQueue]:
+    """Every saved queue, with its songs in order"""
+    with Session() as session:
+        return [
+            RestoredQueue(row.guild_id, row.text_channel_id, row.voice_channel_id, row.loop,
+                          [SongReference(*song) for song in json.loads(row.songs)])
+            for row in session.execute(select(SavedQueue)).scalars()
+        ]
+
+
+class QueueSaver:
+    """
+    Every `SAVE_INTERVAL_SECONDS`, saves the queues in `voice_states` that have changed.
+    Working out what changed is cheap (see `SongQueue.version`), the saving itself happens in a thread.
+    """
+
+    def __init__(self, voice_states: Mapping[int, VoiceState]):
+        self.voice_states = voice_states
+        # guild id -> what its queue looked like when it was last saved
+        self._saved: Dict[int, Hashable] = {}
+        self._save_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, already_saved: List[int] = ()):
+        """`already_saved` are the servers with a queue in the database, which need updating (or deleting)"""
+        for guild_id in already_saved:
+            self._saved[guild_id] = object()
+        self._task = asyncio.get_running_loop().create_task(self._save_periodically())
+
+    async def _save_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL_SECONDS)
+            changes = self._changes()
+            if not changes:
+                continue
+            try:
+                await loop.run_in_executor(None, self._save, changes)
+            except Exception as e:
+                logger.exception(e)
+                # Try again next time
+                for guild_id in changes:
+                    self._saved[guild_id] = object()
+
+    def _save(self, changes: Dict[int, Optional[QueueSnapshot]]):
+        # So the last save on shutdown can't be overwritten by an older one that's still going
+        with self._save_lock:
+            save_queues(changes)
+
+    def _changes(self) -> Dict[int, Optional[QueueSnapshot]]:
+        changes = {}
+        for (guild_id, state) in list(self.voice_states.items()):
+            key = _queue_key(state)
+            if key != self._saved.get(guild_id):
+                changes[guild_id] = _snapshot(state) if key is not None else None
+                if key is not None:
+                    self._saved[guild_id] = key
+                else:
+                    del self._saved[guild_id]
+        for guild_id in [guild_id for guild_id in self._saved if guild_id not in self.voice_states]:
+            del self._saved[guild_id]
+            changes[guild_id] = None
+        return changes
+
+    def stop(self):
+        """Stops saving in the background, after saving whatever's changed one last time"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        changes = self._changes()
+        if changes:
+            self._save(changes)
+
+
+def _playing(state: VoiceState) -> Optional[AbstractAudio]:
+    # Once a song's finished it's still `current`, until the next one starts
+    if state.voice.is_playing() or state.voice.is_paused():
+        return state.current
+    return None
+
+
+def _queue_key(state: VoiceState) -> Optional[Hashable]:
+    """Something that changes whenever the queue needs saving again. None if there's nothing to save"""
+    if state.voice is None or state.voice.channel is None:
+        return None
+    playing = _playing(state)
+    if playing is None and len(state.songs) == 0:
+        return None
+    return (state.songs.version, playing, state.loop, state.channel.id, state.voice.channel.id)
+
+
+def _snapshot(state: VoiceState) -> QueueSnapshot:
+    playing = _playing(state)
+    songs = ([playing] if playing is not None else []) + list(state.songs)
+    return QueueSnapshot(state.channel.id, state.voice.channel.id, state.loop, songs)
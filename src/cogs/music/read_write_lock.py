@@ -0,0 +1,85 @@
+"""
+A lock that lets any number of threads read at once, while a change gets it all to itself
+"""
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+POLL_SECONDS = 0.005    # How often a writer on the event loop checks whether the readers have finished
+
+
+class ReadWriteLock:
+    """
+    Any number of readers, or one writer.
+
+    Writers go first: once one's waiting, new readers wait until it's done,
+    and running readers can check `writers_waiting` to give up early.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @property
+    def writers_waiting(self) -> int:
+        return self._writers_waiting
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writing and self._writers_waiting == 0)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """Blocks until the readers have finished. On the event loop, use `writing_async()`"""
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                self._condition.wait_for(lambda: self._readers == 0 and not self._writing)
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            self._done_writing()
+
+    @asynccontextmanager
+    async def writing_async(self) -> AsyncIterator[None]:
+        """Like `writing()`, but waits on the event loop rather than blocking it"""
+        with self._condition:
+            self._writers_waiting += 1
+        try:
+            while not self._try_writing():
+                await asyncio.sleep(POLL_SECONDS)
+        finally:
+            with self._condition:
+                self._writers_waiting -= 1
+                self._condition.notify_all()
+        try:
+            yield
+        finally:
+            self._done_writing()
+
+    def _try_writing(self) -> bool:
+        with self._condition:
+            if self._readers or self._writing:
+                return False
+            self._writing = True
+            return True
+
+    def _done_writing(self):
+        with self._condition:
+            self._writing = False
+            self._condition.notify_all()
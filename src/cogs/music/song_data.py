@@ -0,0 +1,58 @@
+"""
+The data we store on each local audio file
+"""
+from dataclasses import dataclass
+from math import inf
+from pathlib import Path
+from typing import Optional
+
+from music_tag.id3 import Id3File
+
+
+@dataclass(frozen=True)
+class SongData:
+    """Class for storing information about a local audio file"""
+
+    album: str
+    track_num: int
+    artist: str
+    title: str
+    filepath: str
+    length: float
+    disc_num: Optional[int] = None
+
+    @staticmethod
+    def from_music_tag(song_data: Id3File) -> "SongData":
+        title = song_data.resolve("tracktitle").value
+        # If a file has no title attribute, use its filename (minus the extension)
+        if not title:
+            title = Path(song_data.filename).stem
+
+        return SongData(
+            album=song_data.resolve("album").value or "<None>",
+            track_num=song_data.resolve("tracknumber").value or "<None>",
+            artist=song_data.resolve("artist").value or "<None>",
+            length=song_data.resolve("#length").value,
+            title=title,
+            filepath=song_data.filename,
+            disc_num=song_data.resolve("discnumber").value or None,
+        )
+    
+    def __hash__(self) -> int:
+        return hash(self.filepath)
+    
+    def __eq__(self, other: object) -> bool:
+        """True if they both point to the same file"""
+        return isinstance(other, self.__class__) and self.filepath == other.filepath
+    
+    def __lt__(self, other: 'SongData') -> bool:
+        """
+        Used for sorting songs by their track number 
+
+        If a song has no track number, it'll be sorted to the end of the list
+        If songs share a track number it'll sort by the title alphabetically
+        """
+        self_track_num = self.track_num if isinstance(self.track_num, int) else inf
+        other_track_num = other.track_num if isinstance(other.track_num, int) else inf
+
+        return (self_track_num, self.title.lower()) < (other_track_num, other.title.lower())
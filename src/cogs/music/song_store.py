@@ -0,0 +1,220 @@
+"""
+A compact, column-based store of every song in the library.
+
+Instead of one SongData object per song (plus sets of them for every tag value), each tag value
+is stored once in a table, and songs are rows of integer ids into those tables.
+SongData objects are only created when they're asked for.
+"""
+import sys
+from array import array
+from bisect import bisect_left, insort
+from math import inf, isnan, nan
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .normalize import normalize_value
+from .song_data import SongData
+
+FIELDS = ("title", "artist", "album")
+NO_TRACK_NUM = -1       # Stored in place of "<None>"
+NO_DISC_NUM = -1        # Stored in place of None
+STOP_CHECK_INTERVAL = 1024  # How many rows are intersected between checking if a search should give up
+
+
+def intersect_sorted(*row_lists: Sequence[int], should_stop: Callable[[], bool] = lambda: False) -> array:
+    """
+    The rows that are in every one of `row_lists` (which must each be sorted), as a new sorted array.
+
+    Starts with the shortest list and binary-searches the others for its rows,
+    so it's only as slow as the shortest list. The lists themselves are never modified.
+    If `should_stop()` becomes true partway through, only the rows found so far (if any) are returned
+    """
+    if not row_lists:
+        return array("I")
+    (shortest, *others) = sorted(row_lists, key=len)
+    result = array("I", shortest)
+    for (n, other) in enumerate(others, start=1):
+        kept = array("I")
+        lo = 0
+        for (i, row) in enumerate(result):
+            if i % STOP_CHECK_INTERVAL == 0 and should_stop():
+                # Rows kept from an earlier list haven't been checked against the later ones
+                return kept if n == len(others) else array("I")
+            lo = bisect_left(other, row, lo)
+            if lo == len(other):
+                break
+            if other[lo] == row:
+                kept.append(row)
+        result = kept
+        if not result:
+            break
+    return result
+
+
+class StringTable:
+    """Stores every distinct string once, each with a permanent integer id"""
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self.normalized: List[str] = []     # What's searched (see `normalize_value`), worked out once
+        self._ids: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, value: str) -> int:
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = len(self.strings)
+            self._ids[value] = value_id
+            self.strings.append(value)
+            self.normalized.append(normalize_value(value))
+        return value_id
+
+    def id_of(self, value: str) -> Optional[int]:
+        return self._ids.get(value)
+
+
+class SongStore:
+    """
+    Every song, stored column-by-column. A song's id is its row number.
+
+    Removed rows are left empty and re-used by the next song added.
+    """
+
+    def __init__(self):
+        self.tables: Dict[str, StringTable] = {field: StringTable() for field in FIELDS}
+        # field -> each row's value id
+        self.value_ids: Dict[str, array] = {field: array("I") for field in FIELDS}
+        # field -> value id -> sorted rows with that value
+        self.rows_with_value: Dict[str, List[array]] = {field: [] for field in FIELDS}
+        self.track_nums = array("l")
+        self.disc_nums = array("l")
+        self.lengths = array("d")
+        self.filepaths: List[Optional[str]] = []
+        self._row_of_path: Dict[str, int] = {}
+        self._free_rows: List[int] = []
+
+    def __len__(self):
+        return len(self._row_of_path)
+
+    def add(self, song: SongData) -> int:
+        """Stores the song, returning its row. A song with the same filepath must be removed first"""
+        track_num = song.track_num if isinstance(song.track_num, int) else NO_TRACK_NUM
+        disc_num = song.disc_num if isinstance(song.disc_num, int) else NO_DISC_NUM
+        length = song.length if song.length is not None else nan
+        if self._free_rows:
+            row = self._free_rows.pop()
+            self.track_nums[row] = track_num
+            self.disc_nums[row] = disc_num
+            self.lengths[row] = length
+            self.filepaths[row] = song.filepath
+        else:
+            row = len(self.filepaths)
+            self.track_nums.append(track_num)
+            self.disc_nums.append(disc_num)
+            self.lengths.append(length)
+            self.filepaths.append(song.filepath)
+            for field in FIELDS:
+                self.value_ids[field].append(0)
+        self._row_of_path[song.filepath] = row
+
+        for field in FIELDS:
+            value_id = self.tables[field].intern(getattr(song, field))
+            self.value_ids[field][row] = value_id
+            rows_with_value = self.rows_with_value[field]
+            if value_id == len(rows_with_value):
+                rows_with_value.append(array("I"))
+            insort(rows_with_value[value_id], row)
+        return row
+
+    def remove(self, row: int):
+        for field in FIELDS:
+            rows = self.rows_with_value[field][self.value_ids[field][row]]
+            del rows[bisect_left(rows, row)]
+        del self._row_of_path[self.filepaths[row]]
+        self.filepaths[row] = None
+        self._free_rows.append(row)
+
+    def rows_with(self, field: str, value: str) -> Sequence[int]:
+        """The sorted rows of every song with this value. Don't modify it!"""
+        value_id = self.tables[field].id_of(value)
+        return self.rows_with_value[field][value_id] if value_id is not None else ()
+
+    def row_of(self, filepath: str) -> Optional[int]:
+        return self._row_of_path.get(filepath)
+
+    def rows(self) -> Iterator[int]:
+        """Every row that holds a song"""
+        return iter(self._row_of_path.values())
+
+    def value(self, field: str, row: int) -> str:
+        return self.tables[field].strings[self.value_ids[field][row]]
+
+    def song(self, row: int) -> SongData:
+        """Creates the SongData for this row"""
+        track_num = self.track_nums[row]
+        disc_num = self.disc_nums[row]
+        length = self.lengths[row]
+        return SongData(
+            album=self.value("album", row),
+            track_num=track_num if track_num != NO_TRACK_NUM else "<None>",
+            artist=self.value("artist", row),
+            title=self.value("title", row),
+            filepath=self.filepaths[row],
+            length=length if not isnan(length) else None,
+            disc_num=disc_num if disc_num != NO_DISC_NUM else None,
+        )
+
+    def track_order(self, row: int) -> Tuple[int, float, str]:
+        """
+        Sorts songs the way they're ordered on the album: by disc, then track number, then title.
+        Songs without a disc number count as disc 1, songs without a track number go at the end of their disc
+        """
+        disc_num = self.disc_nums[row]
+        track_num = self.track_nums[row]
+        return (
+            disc_num if disc_num != NO_DISC_NUM else 1,
+            track_num if track_num != NO_TRACK_NUM else inf,
+            self.tables["title"].normalized[self.value_ids["title"][row]],
+        )
+
+    def memory_report(self) -> Dict[str, int]:
+        """
+        Roughly how many bytes the songs take up, compared to storing them as a list of SongData
+        (with `{field: {value: set of SongData}}` indexes, like the library used to)
+        """
+        n_songs = len(self)
+        columnar = (
+            sys.getsizeof(self.track_nums) + sys.getsizeof(self.disc_nums) + sys.getsizeof(self.lengths)
+            + sys.getsizeof(self.filepaths) + sys.getsizeof(self._row_of_path)
+            + sum(sys.getsizeof(path) for path in self._row_of_path)
+        )
+        for field in FIELDS:
+            table = self.tables[field]
+            columnar += sys.getsizeof(self.value_ids[field]) + sys.getsizeof(table.strings) + sys.getsizeof(table._ids)
+            columnar += sum(sys.getsizeof(value) for value in table.strings)
+            columnar += sum(sys.getsizeof(normalized) for (value, normalized) in zip(table.strings, table.normalized)
+                            if normalized is not value)
+            columnar += sys.getsizeof(self.rows_with_value[field])
+            columnar += sum(sys.getsizeof(rows) for rows in self.rows_with_value[field])
+
+        dataclasses = sys.getsizeof([None] * n_songs)
+        set_sizes: Dict[int, int] = {}
+        for row in self.rows():
+            song = self.song(row)
+            dataclasses += sys.getsizeof(song) + sys.getsizeof(song.__dict__)
+            # Every song had its own copy of each string, straight from its file's tags
+            dataclasses += sum(sys.getsizeof(getattr(song, field)) for field in FIELDS)
+            dataclasses += sys.getsizeof(song.filepath) + sys.getsizeof(song.length) + sys.getsizeof(song.track_num)
+        for field in FIELDS:
+            n_values = 0
+            for rows in self.rows_with_value[field]:
+                if not rows:
+                    continue
+                n_values += 1
+                if len(rows) not in set_sizes:
+                    set_sizes[len(rows)] = sys.getsizeof(set(range(len(rows))))
+                dataclasses += set_sizes[len(rows)]
+            dataclasses += sys.getsizeof(dict.fromkeys(range(n_values)))
+
+        return {"songs": n_songs, "columnar_bytes": columnar, "dataclass_bytes": dataclasses}
@@ -0,0 +1,188 @@
+"""
+A persistent cache of local music tags, so restarting the bot doesn't re-parse the whole library.
+
+Files are matched on their path, size and modified time. If any of those change, it's re-parsed.
+Each music folder gets its own TagCache (holding just that folder's files), so folders can be scanned at the same time.
+"""
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import delete, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+
+from ..db import Session, engine
+from ..db.tables import CachedSongTags
+from .song_data import SongData
+
+WRITE_BATCH_SIZE = 5000     # How many rows get written to the database at once
+
+logger = logging.getLogger(__name__)
+
+# SQLite only allows one writer at a time, so the folders' caches take turns
+_database_lock = threading.Lock()
+
+
+def walk_music_folder(folder: str) -> Iterator[Tuple[str, int, int]]:
+    """
+    Recursively yields every file in `folder`, as (filepath, size, mtime_ns)
+    """
+    for (dirname, _, filenames) in os.walk(folder):
+        for fname in filenames:
+            full_path = os.path.join(dirname, fname)
+            try:
+                stat = os.stat(full_path)
+            except OSError as e:
+                logger.warning(f"Couldn't read {full_path!r}: {e!r}")
+                continue
+            yield (full_path, stat.st_size, stat.st_mtime_ns)
+
+
+@dataclass
+class ScanSummary:
+    """How much work the tag cache saved during a scan"""
+    hits: int = 0       # Unchanged files, read straight from the cache
+    misses: int = 0     # New or changed files, which had to be parsed
+    removed: int = 0    # Files that were deleted since the last scan
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.hits} file(s) unchanged (cached), {self.misses} parsed, "
+                f"{self.removed} removed ({self.hit_rate:.1%} cache hit rate)")
+
+
+def _row_to_song(row) -> Optional[SongData]:
+    if row.title is None:
+        return None
+    return SongData(
+        album=row.album,
+        track_num=row.track_num if row.track_num is not None else "<None>",
+        artist=row.artist,
+        title=row.title,
+        filepath=row.filepath,
+        length=row.length,
+        disc_num=row.disc_num,
+    )
+
+
+def _song_to_row(filepath: str, size: int, mtime_ns: int, song: Optional[SongData]) -> dict:
+    row = dict(filepath=filepath, size=size, mtime_ns=mtime_ns,
+               title=None, album=None, artist=None, track_num=None, disc_num=None, length=None)
+    if song is not None:
+        row.update(
+            title=song.title,
+            album=song.album,
+            artist=song.artist,
+            track_num=song.track_num if isinstance(song.track_num, int) else None,
+            disc_num=song.disc_num,
+            length=song.length,
+        )
+    return row
+
+
+def _create_table():
+    """Creates the cache's table. If it's from an older version (missing columns), it's thrown away"""
+    table = CachedSongTags.__table__
+    inspector = inspect(engine)
+    if inspector.has_table(table.name):
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        if existing_columns == set(table.columns.keys()):
+            return
+        logger.warning("The tag cache is from an older version, so every file will be re-parsed")
+        table.drop(engine)
+    table.create(engine)
+
+
+class TagCache:
+    """
+    Every file in `folder` we've seen before, and what we found when we parsed it.
+
+    Changes are staged with `update()`/`remove()`, and only written to the database on `commit()`.
+    If that fails, the staged changes are undone, so the files look changed (and get re-read) next time
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        # filepath -> (size, mtime_ns, song). `song` is None if the file isn't a song.
+        self._entries: Dict[str, Tuple[int, int, Optional[SongData]]] = {}
+        self._pending_writes: Dict[str, dict] = {}
+        self._pending_deletes: Set[str] = set()
+        # filepath -> its entry before its change was staged (None if it wasn't cached)
+        self._staged_from: Dict[str, Optional[Tuple[int, int, Optional[SongData]]]] = {}
+
+        table = CachedSongTags.__table__
+        with _database_lock:
+            _create_table()
+        with Session() as session:
+            in_folder = table.c.filepath.startswith(os.path.join(folder, ""), autoescape=True)
+            for row in session.execute(select(table).where(in_folder)):
+                self._entries[row.filepath] = (row.size, row.mtime_ns, _row_to_song(row))
+        logger.info(f"Loaded {len(self._entries)} cached file tag(s) for {folder}")
+
+    def __contains__(self, filepath: str) -> bool:
+        return filepath in self._entries
+
+    def is_fresh(self, filepath: str, size: int, mtime_ns: int) -> bool:
+        """True if the file hasn't changed since it was cached"""
+        entry = self._entries.get(filepath)
+        return entry is not None and entry[0] == size and entry[1] == mtime_ns
+
+    def get(self, filepath: str) -> Optional[SongData]:
+        """The cached song. None if it isn't a song, or isn't cached"""
+        entry = self._entries.get(filepath)
+        return entry[2] if entry is not None else None
+
+    def paths_under(self, folder: str) -> Set[str]:
+        """Every cached file inside `folder`"""
+        prefix = os.path.join(folder, "")
+        return {path for path in self._entries if path.startswith(prefix)}
+
+    def update(self, filepath: str, size: int, mtime_ns: int, song: Optional[SongData]):
+        self._staged_from.setdefault(filepath, self._entries.get(filepath))
+        self._entries[filepath] = (size, mtime_ns, song)
+        self._pending_deletes.discard(filepath)
+        self._pending_writes[filepath] = _song_to_row(filepath, size, mtime_ns, song)
+
+    def remove(self, filepath: str):
+        self._staged_from.setdefault(filepath, self._entries.get(filepath))
+        self._entries.pop(filepath, None)
+        self._pending_writes.pop(filepath, None)
+        self._pending_deletes.add(filepath)
+
+    def commit(self):
+        """Writes every staged change to the database"""
+        if not self._pending_writes and not self._pending_deletes:
+            return
+        table = CachedSongTags.__table__
+        rows: List[dict] = list(self._pending_writes.values())
+        deletes: List[str] = list(self._pending_deletes)
+        try:
+            with _database_lock, Session() as session:
+                for i in range(0, len(rows), WRITE_BATCH_SIZE):
+                    stmt = insert(table)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[table.c.filepath],
+                        set_={col: stmt.excluded[col] for col in rows[0] if col != "filepath"},
+                    )
+                    session.execute(stmt, rows[i:i + WRITE_BATCH_SIZE])
+                for i in range(0, len(deletes), WRITE_BATCH_SIZE):
+                    session.execute(delete(table).where(table.c.filepath.in_(deletes[i:i + WRITE_BATCH_SIZE])))
+                session.commit()
+        except BaseException:
+            # e.g. "database is locked". The database is unchanged, so the entries go back to matching it
+            for (filepath, entry) in self._staged_from.items():
+                if entry is None:
+                    self._entries.pop(filepath, None)
+                else:
+                    self._entries[filepath] = entry
+            raise
+        finally:
+            self._pending_writes.clear()
+            self._pending_deletes.clear()
+            self._staged_from.clear()
@@ -0,0 +1,50 @@
+"""
+Keeps the best `k` search results as they're scored, instead of sorting every match at the end
+"""
+import heapq
+from itertools import count
+from typing import Any, Generic, List, Optional, Set, Tuple, TypeVar
+
+Rank = Tuple[float, ...]    # Higher is better
+T = TypeVar("T")
+
+
+class TopK(Generic[T]):
+    """
+    The `k` highest-ranked values pushed so far, at most one entry per value.
+
+    A min-heap of the kept entries, so checking (and replacing) the worst one is O(log k),
+    and it never holds more than `k` entries. Ties go to whichever was pushed first.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        # (rank, -push order, value, item). The worst kept entry is at the top
+        self._heap: List[Tuple[Rank, int, str, T]] = []
+        self._values: Set[str] = set()
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def worst_rank(self) -> Optional[Rank]:
+        """The rank a value has to beat to get in, or None if there's still room"""
+        return self._heap[0][0] if len(self._heap) >= self.k else None
+
+    def push(self, rank: Rank, value: str, item: T = None):
+        """Offers `value`. If it's already been pushed, the first push is kept"""
+        if value in self._values:
+            return
+        entry = (rank, -next(self._counter), value, item)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            self._values.discard(heapq.heapreplace(self._heap, entry)[2])
+        else:
+            return
+        self._values.add(value)
+
+    def best_first(self) -> List[Tuple[Rank, str, Any]]:
+        """The kept (rank, value, item)s, best first"""
+        return [(rank, value, item)
+                for (rank, _order, value, item) in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
@@ -0,0 +1,198 @@
+"""
+Limits how many ffmpeg processes (transcodes) the whole bot runs at once.
+
+Without it, a burst of `play`s across lots of servers starts one ffmpeg each, all at the same time.
+Instead, every audio source is opened through the scheduler, which hands out a limited number of slots.
+Servers waiting for a slot take turns, so one server queueing up a playlist can't starve the rest.
+A source opened ahead of time (prefetched) only takes a slot once it starts playing, see `schedule()`.
+"""
+import asyncio
+import logging
+import os
+import statistics
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, NamedTuple, Optional
+
+import discord
+
+from .latency_metrics import latency_metrics
+
+WAIT_HISTORY_SIZE = 1000    # How many recent waits are used for the wait time stats
+SLOW_WAIT_SECONDS = 1       # Waits longer than this are logged
+
+logger = logging.getLogger(__name__)
+
+
+def default_max_transcodes() -> int:
+    """Decoding's cheap next to encoding, so a few per CPU core"""
+    return 4 * (os.cpu_count() or 1)
+
+
+class SchedulerStats(NamedTuple):
+    running: int            # Slots in use
+    max_running: int
+    queued: int             # Transcodes waiting for a slot
+    queued_servers: int     # Servers with at least one transcode waiting
+    started: int            # Transcodes started since the bot started
+    wait_p50: float         # Seconds spent waiting for a slot, over the last `WAIT_HISTORY_SIZE` transcodes
+    wait_p95: float
+    wait_max: float
+
+
+class TranscodeSlot:
+    """Permission to run one transcode. Release it once the transcode's finished (from any thread)"""
+
+    def __init__(self, scheduler: "TranscodeScheduler"):
+        self._scheduler = scheduler
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            self._scheduler._loop.call_soon_threadsafe(self._scheduler._release)
+        except RuntimeError:
+            # The event loop's closed, so the bot's shutting down anyway
+            pass
+
+
+class ScheduledSource(discord.AudioSource):
+    """An audio source that gives its transcode slot back once discord.py's done with it"""
+
+    def __init__(self, source: discord.AudioSource, slot: TranscodeSlot):
+        self.source = source
+        self.slot = slot
+
+    def read(self) -> bytes:
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        try:
+            self.source.cleanup()
+        finally:
+            self.slot.release()
+
+
+class TranscodeScheduler:
+    """
+    Hands out up to `max_running` transcode slots. Each slot's held until its audio source is cleaned up.
+
+    Waiting transcodes are queued per server (or any other key), and servers are served round-robin.
+    """
+
+    def __init__(self, max_running: int):
+        self.max_running = max_running
+        self._running = 0
+        self._started = 0
+        # server -> its waiting transcodes, in order. The server at the front is served next
+        self._waiting: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._waits: Deque[float] = deque(maxlen=WAIT_HISTORY_SIZE)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def acquire(self, server: Hashable) -> TranscodeSlot:
+        """Waits for a free slot, taking turns with the other servers that are waiting"""
+        self._loop = asyncio.get_running_loop()
+        started_waiting = time.monotonic()
+        if self._running >= self.max_running or self._waiting:
+            turn = self._loop.create_future()
+            self._waiting.setdefault(server, deque()).append(turn)
+            try:
+                await turn
+            except asyncio.CancelledError:
+                if turn.done() and not turn.cancelled():
+                    # Given a slot just as it gave up waiting, so pass it on
+                    self._release()
+                else:
+                    self._forget(server, turn)
+                raise
+        else:
+            self._running += 1
+        waited = time.monotonic() - started_waiting
+        self._waits.append(waited)
+        latency_metrics.observe("transcode_wait", waited, server)
+        self._started += 1
+        if waited >= SLOW_WAIT_SECONDS:
+            logger.info("Waited %.1fs for a transcode slot (%d still waiting)", waited, self.queued)
+        return TranscodeSlot(self)
+
+    async def open(self, server: Hashable, generate_source: Callable[[], Awaitable[discord.AudioSource]]
+                   ) -> ScheduledSource:
+        """Waits for a slot, then opens the source with `generate_source()`"""
+        slot = await self.acquire(server)
+        try:
+            source = await generate_source()
+        except BaseException:
+            slot.release()
+            raise
+        return ScheduledSource(source, slot)
+
+    async def schedule(self, server: Hashable, source: discord.AudioSource) -> ScheduledSource:
+        """
+        Waits for a slot for a source that's already open, e.g. prefetched.
+        Until it's read from, its ffmpeg's just waiting, so it doesn't need a slot before then.
+        The source is cleaned up if it can't get one
+        """
+        try:
+            slot = await self.acquire(server)
+        except BaseException:
+            source.cleanup()
+            raise
+        return ScheduledSource(source, slot)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(turns) for turns in self._waiting.values())
+
+    def _forget(self, server: Hashable, turn: asyncio.Future):
+        turns = self._waiting.get(server)
+        if turns is None:
+            return
+        try:
+            turns.remove(turn)
+        except ValueError:
+            pass
+        if not turns:
+            del self._waiting[server]
+
+    def _release(self):
+        """A slot's free. Give it to the next server in line"""
+        while self._waiting:
+            (server, turns) = self._waiting.popitem(last=False)
+            turn = turns.popleft()
+            if turns:
+                # Back of the line, until every other waiting server's had a turn
+                self._waiting[server] = turns
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self._running -= 1
+
+    def stats(self) -> SchedulerStats:
+        waits = sorted(self._waits) or [0.0]
+        return SchedulerStats(
+            running=self._running,
+            max_running=self.max_running,
+            queued=self.queued,
+            queued_servers=len(self._waiting),
+            started=self._started,
+            wait_p50=statistics.median(waits),
+            wait_p95=waits[min(len(waits) - 1, int(len(waits) * 0.95))],
+            wait_max=waits[-1],
+        )
+
+
+_scheduler: Optional[TranscodeScheduler] = None
+
+
+def get_transcode_scheduler() -> TranscodeScheduler:
+    """The scheduler every transcode goes through. Set up from the .env file the first time it's needed"""
+    global _scheduler
+    if _scheduler is None:
+        max_running = os.environ.get("MAX_TRANSCODES")
+        _scheduler = TranscodeScheduler(int(max_running) if max_running else default_max_transcodes())
+    return _scheduler
@@ -0,0 +1,71 @@
+"""
+Picks random tag values (e.g. albums) to suggest when a field's empty
+"""
+import random
+from collections import OrderedDict
+from typing import Dict, List
+
+PLAY_HISTORY_SIZE = 100     # How many recently played values are remembered
+
+
+class ValueSampler:
+    """
+    Every distinct value of one field, kept in a list so `k` random values can be picked in O(k),
+    instead of shuffling all of them.
+
+    Optionally, some of the picks can favour values that have been played recently or often.
+    """
+
+    def __init__(self):
+        self._values: List[str] = []
+        self._positions: Dict[str, int] = {}
+        # value -> times played. The most recently played are at the end
+        self._plays: "OrderedDict[str, int]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value: str):
+        if value in self._positions:
+            return
+        self._positions[value] = len(self._values)
+        self._values.append(value)
+
+    def remove(self, value: str):
+        position = self._positions.pop(value, None)
+        if position is None:
+            return
+        # Swap the last value into the gap, so nothing else has to move
+        last = self._values.pop()
+        if last != value:
+            self._values[position] = last
+            self._positions[last] = position
+        self._plays.pop(value, None)
+
+    def record_play(self, value: str):
+        if value not in self._positions:
+            return
+        self._plays[value] = self._plays.get(value, 0) + 1
+        self._plays.move_to_end(value)
+        if len(self._plays) > PLAY_HISTORY_SIZE:
+            self._plays.popitem(last=False)
+
+    def sample(self, k: int, played_share: float = 0.0) -> List[str]:
+        """
+        Up to `k` different random values.
+        `played_share` of them (e.g. 0.2 = 20%) are picked from recently played values, favouring the most played.
+        """
+        picked: Dict[str, None] = {}
+        n_played = min(round(k * played_share), len(self._plays))
+        if n_played:
+            # Weighted sampling without replacement: highest `random ** (1 / weight)` wins
+            keys = {value: random.random() ** (1 / plays) for (value, plays) in self._plays.items()}
+            for value in sorted(keys, key=keys.__getitem__, reverse=True)[:n_played]:
+                picked[value] = None
+        # Might pick some of the played ones again, so pick a few extra
+        n_random = min(k, len(self._values))
+        for position in random.sample(range(len(self._values)), min(n_random + len(picked), len(self._values))):
+            if len(picked) >= n_random:
+                break
+            picked.setdefault(self._values[position])
+        return list(picked)
@@ -1,26 +1,72 @@
 import asyncio
-import itertools
 import logging
-import random
-from typing import Optional
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Iterable, Optional, Tuple
 
 import discord
 from async_timeout import timeout
 from discord.ext import commands
 
 from .abstract_audio import AbstractAudio
+from .indexed_list import IndexedList
+from .latency_metrics import FirstPacketTimer, current_guild, latency_metrics
+from .transcode_scheduler import get_transcode_scheduler
+
+PREFETCH_LEAD_SECONDS = 20      # The next song starts loading this long before the current one ends
+PREFETCH_CHECK_SECONDS = 2      # How often the prefetched song's checked against the queue
+PREFETCH_MAX_AGE_SECONDS = 120  # A prefetched stream that's been waiting this long is re-opened (e.g. it was paused)
+GAP_HISTORY_SIZE = 100          # How many gaps between songs are remembered
 
 logger = logging.getLogger(__name__)
 
 class VoiceError(commands.CommandInvokeError):
     pass
 
+
+@dataclass
+class _Prefetch:
+    """
+    The next song's audio source, being (or already) opened while the current song plays.
+    It doesn't take a transcode slot until it starts playing, so it can't hold one up while it waits
+    """
+    audio: AbstractAudio
+    task: "asyncio.Task[discord.AudioSource]"
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def is_expired(self) -> bool:
+        return time.monotonic() - self.started_at > PREFETCH_MAX_AGE_SECONDS
+
+    def discard(self):
+        """Stops loading it, or closes it (e.g. killing its ffmpeg) if it's loaded"""
+        if not self.task.done():
+            self.task.cancel()
+        elif not self.task.cancelled() and self.task.exception() is None:
+            self.task.result().cleanup()
+
 class SongQueue(asyncio.Queue[AbstractAudio]):
+    """
+    The songs waiting to be played. Backed by an IndexedList rather than a deque,
+    so removing, moving and paging through songs stays fast in queues with thousands of songs
+    """
+
+    def _init(self, maxsize: int):
+        self._queue: IndexedList[AbstractAudio] = IndexedList()
+        # Goes up every time the queue changes, so it's cheap to tell if it needs saving again
+        self.version = 0
+
+    def _put(self, item: AbstractAudio):
+        self._queue.append(item)
+        self.version += 1
+
+    def _get(self) -> AbstractAudio:
+        self.version += 1
+        return self._queue.popleft()
+
     def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+        return self._queue[item]
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -28,19 +74,40 @@ class SongQueue(asyncio.Queue[AbstractAudio]):
     def __len__(self):
         return self.qsize()
 
+    def put_many(self, items: Iterable[AbstractAudio]):
+        """
+        Adds every song at once (e.g. a whole playlist), waking the player up just once,
+        rather than once per song
+        """
+        items = list(items)
+        if not items:
+            return
+        self._queue.extend(items)
+        self.version += 1
+        self._unfinished_tasks += len(items)
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+
     def clear(self):
         self._queue.clear()
+        self.version += 1
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        self._queue.shuffle()
+        self.version += 1
 
     def pop(self, index: int = -1) -> AbstractAudio:
-        ret = self._queue[index]
-        del self._queue[index]
-        return ret
+        item = self._queue.pop(index)
+        self.version += 1
+        return item
 
     def insert(self, index: int, item: AbstractAudio):
         self._queue.insert(index, item)
+        self.version += 1
+
+    def move(self, old_index: int, new_index: int):
+        self._queue.insert(new_index, self._queue.pop(old_index))
+        self.version += 1
 
 class VoiceState:
     def __init__(self, bot: commands.Bot, channel: discord.TextChannel):
@@ -54,11 +121,14 @@ class VoiceState:
 
         self._loop = False
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        # The next song's loaded while this one plays, so there's no silence between them
+        self._prefetch: Optional[_Prefetch] = None
+        self._prefetcher: Optional[asyncio.Task] = None
+        self._song_ended_at: Optional[float] = None
+        # Seconds of silence between one song ending and the next starting (when the next was already queued)
+        self.gaps: Deque[float] = deque(maxlen=GAP_HISTORY_SIZE)
 
-    def __del__(self):
-        logger.info("Deleting VoiceState in channel {}", self.channel.name)
-        self.audio_player.cancel()
+        self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     @property
     def loop(self):
@@ -78,9 +148,13 @@ class VoiceState:
 
     async def audio_player_task(self) -> None:
         self.current = None
+        # Everything this starts (e.g. prefetching) records its latency against this server
+        current_guild.set(self.channel.guild.id)
         try:
             while True:
                 self.next.clear()
+                # Nothing's queued, so the next song is played as soon as it's added
+                cold_start = not self.loop and len(self.songs) == 0
 
                 if not self.loop:
                     # Try to get the next song within 3 minutes.
@@ -91,13 +165,30 @@ class VoiceState:
                         self.current = await self.songs.get()
 
                 print("Got song", self.current)
-                source = await self.current.generate_source()
-                self.voice.play(source, after=self.play_next_song)
+                (source, was_prefetched) = await self._open_source(self.current)
+                first_packet_stages = [("first_packet", time.monotonic())]
+                if cold_start and self.current.requested_at is not None:
+                    first_packet_stages.append(("command_to_first_audio", self.current.requested_at))
+                try:
+                    source = FirstPacketTimer(source, first_packet_stages, self.channel.guild.id)
+                    self.voice.play(source, after=self.play_next_song)
+                except BaseException:
+                    # e.g. not connected anymore. discord.py only cleans up sources it's started playing
+                    source.cleanup()
+                    raise
+                # e.g. so the cog can count it as played
+                self.bot.dispatch("song_started", self, self.current)
+                self._record_gap(was_prefetched)
+                self._prefetcher = self.bot.loop.create_task(self._keep_next_song_ready(self.current))
                 
                 if not self.loop:
                     await self.channel.send(embed=self.current.create_embed())
 
                 await self.next.wait()
+                self._prefetcher.cancel()
+                # Only count the silence if there was a song waiting to be played
+                if not self.loop and len(self.songs) == 0:
+                    self._song_ended_at = None
         except asyncio.TimeoutError:
             if self.voice:
                 print("This bot needs her beauty sleep! (timed out due to inactivity)")
@@ -110,7 +201,64 @@ class VoiceState:
             await self.stop()
 
 
+    def _upcoming(self) -> Optional[AbstractAudio]:
+        """The song that'll play after this one, if it's known yet"""
+        if self.loop:
+            return self.current
+        return self.songs[0] if len(self.songs) > 0 else None
+
+    async def _keep_next_song_ready(self, playing: AbstractAudio):
+        """
+        Opens the next song's source shortly before `playing` ends.
+        Until then, it keeps checking that it's still the next song (it might be skipped, moved, shuffled...)
+        Songs without a length (like livestreams) could play for hours, so the next song is just opened when it's needed
+        """
+        try:
+            length = playing.length
+        except (KeyError, TypeError):
+            length = None
+        if not length:
+            return
+        await asyncio.sleep(max(0, length - PREFETCH_LEAD_SECONDS))
+        while True:
+            upcoming = self._upcoming()
+            if self._prefetch is not None and (self._prefetch.audio is not upcoming or self._prefetch.is_expired):
+                self._prefetch.discard()
+                self._prefetch = None
+            if upcoming is not None and self._prefetch is None:
+                self._prefetch = _Prefetch(upcoming, self.bot.loop.create_task(upcoming.generate_source()))
+            await asyncio.sleep(PREFETCH_CHECK_SECONDS)
+
+    async def _open_source(self, audio: AbstractAudio) -> Tuple[discord.AudioSource, bool]:
+        """`audio`'s source, and whether it was already prefetched"""
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            if prefetch.audio is audio and not prefetch.is_expired:
+                try:
+                    source = await prefetch.task
+                except Exception as e:
+                    logger.warning("Prefetching %s failed, trying again: %r", audio.name, e)
+                else:
+                    return (await get_transcode_scheduler().schedule(self.channel.guild.id, source), True)
+            else:
+                prefetch.discard()
+        return (await self._generate_source(audio), False)
+
+    async def _generate_source(self, audio: AbstractAudio) -> discord.AudioSource:
+        """Opens `audio`, once the bot-wide transcode scheduler says there's room for another ffmpeg"""
+        return await get_transcode_scheduler().open(self.channel.guild.id, audio.generate_source)
+
+    def _record_gap(self, was_prefetched: bool):
+        if self._song_ended_at is None:
+            return
+        gap = time.monotonic() - self._song_ended_at
+        self._song_ended_at = None
+        self.gaps.append(gap)
+        latency_metrics.observe("track_gap", gap, self.channel.guild.id)
+        logger.info("%.0fms between songs (prefetched: %s)", gap * 1000, was_prefetched)
+
     def play_next_song(self, error=None):
+        self._song_ended_at = time.monotonic()
         if error:
             raise VoiceError(str(error))
 
@@ -120,9 +268,34 @@ class VoiceState:
         if self.is_playing:
             self.voice.stop()
 
+    @property
+    def ffmpeg_processes(self) -> int:
+        """How many ffmpegs this has running: the song that's playing, and the next song if it's prefetched"""
+        running = 0
+        if self.voice is not None and (self.voice.is_playing() or self.voice.is_paused()):
+            running += 1
+        if self._prefetch is not None and self._prefetch.task.done() and not self._prefetch.task.cancelled() \
+                and self._prefetch.task.exception() is None:
+            running += 1
+        return running
+
     async def stop(self):
         self.songs.clear()
         self.current = None
+        if self._prefetcher is not None:
+            self._prefetcher.cancel()
+        if self._prefetch is not None:
+            self._prefetch.discard()
+            self._prefetch = None
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
+
+    def close(self):
+        """Stops the audio player (and prefetching) for good, without waiting. Call `stop()` first to disconnect"""
+        self.audio_player.cancel()
+        if self._prefetcher is not None:
+            self._prefetcher.cancel()
+        if self._prefetch is not None:
+            self._prefetch.discard()
+            self._prefetch = None
@@ -0,0 +1,197 @@
+"""
+Creates, keeps track of and cleans up every server's VoiceState.
+
+A VoiceState's forgotten as soon as its audio player stops (e.g. it timed out waiting for songs),
+and is made to leave once it's been alone in its voice channel for `ALONE_TIMEOUT_SECONDS`.
+Tearing one down (disconnecting) is given `TEARDOWN_TIMEOUT_SECONDS`, so a stuck disconnect can't hang the bot.
+"""
+import asyncio
+import logging
+import sys
+import time
+from typing import Dict, Iterator, Mapping, NamedTuple, Optional, Set
+
+import discord
+from discord.ext import commands
+
+from .latency_metrics import latency_metrics
+from .opus_cache import OpusCache
+from .transcode_scheduler import get_transcode_scheduler
+from .voice_state import VoiceState
+
+REAP_INTERVAL_SECONDS = 30      # How often voice states are checked for being alone
+ALONE_TIMEOUT_SECONDS = 300     # How long the bot stays in a voice channel with nobody else in it
+TEARDOWN_TIMEOUT_SECONDS = 10   # How long a voice state gets to disconnect
+MEMORY_SAMPLE_SIZE = 50         # How many of a queue's songs are measured, to estimate the queue's memory use
+
+logger = logging.getLogger(__name__)
+
+# Shared between songs (and other servers), so they don't count towards a server's memory use
+_SHARED_TYPES = (discord.abc.Snowflake, discord.Client, OpusCache)
+
+
+class VoiceStateStats(NamedTuple):
+    live: int                       # Voice states that exist
+    playing: int                    # ...which are playing a song
+    queued_songs: int               # Songs waiting, across every server
+    ffmpeg_processes: int           # ffmpegs the voice states have running (playing or prefetched)
+    transcodes_running: int         # Transcode slots in use across the bot (songs playing, and the Opus cache)
+    memory_bytes: Dict[int, int]    # Roughly how much memory each server's voice state uses
+
+
+class VoiceStateManager(Mapping[int, VoiceState]):
+    """Every server's VoiceState, by server id"""
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self._states: Dict[int, VoiceState] = {}
+        # server id -> when the bot was first seen alone in its voice channel
+        self._alone_since: Dict[int, float] = {}
+        self._teardowns: Set[asyncio.Task] = set()
+        self._reaper: Optional[asyncio.Task] = None
+
+    def __getitem__(self, guild_id: int) -> VoiceState:
+        return self._states[guild_id]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._states)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def start(self):
+        self._reaper = asyncio.get_running_loop().create_task(self._reap_periodically())
+
+    def get_or_create(self, channel: discord.TextChannel) -> VoiceState:
+        """The server's voice state. A new one's made if it doesn't have one, or its audio player has stopped"""
+        guild_id = channel.guild.id
+        state = self._states.get(guild_id)
+        # It might not be connected yet (another command could still be joining), but it's still in use
+        if state is not None and not state.audio_player.done():
+            return state
+        if state is not None:
+            # Its audio player's stopped, so there's nothing to disconnect
+            state.close()
+        state = VoiceState(self.bot, channel)
+        self._states[guild_id] = state
+        self._alone_since.pop(guild_id, None)
+        state.audio_player.add_done_callback(lambda _: self._forget(guild_id, state))
+        return state
+
+    def _forget(self, guild_id: int, state: VoiceState):
+        """Called once a voice state's audio player has stopped"""
+        if self._states.get(guild_id) is state:
+            del self._states[guild_id]
+            self._alone_since.pop(guild_id, None)
+            latency_metrics.forget_guild(guild_id)
+            logger.info("Voice state for server %s has stopped (%d left)", guild_id, len(self._states))
+
+    async def remove(self, guild_id: int):
+        """Disconnects the server's voice state and stops its audio player"""
+        state = self._states.pop(guild_id, None)
+        self._alone_since.pop(guild_id, None)
+        latency_metrics.forget_guild(guild_id)
+        if state is not None:
+            await self._teardown(state)
+
+    async def _teardown(self, state: VoiceState):
+        try:
+            await asyncio.wait_for(state.stop(), TEARDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Voice state for server %s took over %ds to disconnect, giving up on it",
+                           state.channel.guild.id, TEARDOWN_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            state.close()
+
+    def _remove_in_background(self, guild_id: int):
+        task = asyncio.get_running_loop().create_task(self.remove(guild_id))
+        self._teardowns.add(task)
+        task.add_done_callback(self._teardowns.discard)
+
+    async def _reap_periodically(self):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL_SECONDS)
+            now = time.monotonic()
+            for (guild_id, state) in list(self._states.items()):
+                if not _is_alone(state):
+                    self._alone_since.pop(guild_id, None)
+                    continue
+                alone_since = self._alone_since.setdefault(guild_id, now)
+                if now - alone_since >= ALONE_TIMEOUT_SECONDS:
+                    logger.info("Leaving server %s, nobody's been listening for %ds", guild_id, now - alone_since)
+                    self._remove_in_background(guild_id)
+
+    async def close(self):
+        """Stops every voice state, taking at most `TEARDOWN_TIMEOUT_SECONDS`"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+        states = list(self._states.values())
+        self._states.clear()
+        self._alone_since.clear()
+        await asyncio.gather(*(self._teardown(state) for state in states), *self._teardowns)
+
+    def stats(self) -> VoiceStateStats:
+        states = list(self._states.items())
+        return VoiceStateStats(
+            live=len(states),
+            playing=sum(1 for (_, state) in states if state.is_playing),
+            queued_songs=sum(len(state.songs) for (_, state) in states),
+            ffmpeg_processes=sum(state.ffmpeg_processes for (_, state) in states),
+            transcodes_running=get_transcode_scheduler().stats().running,
+            memory_bytes={guild_id: _approximate_size(state) for (guild_id, state) in states},
+        )
+
+    def prometheus_text(self) -> str:
+        """The stats, in Prometheus' text format"""
+        stats = self.stats()
+        lines = []
+        for name in ("live", "playing", "queued_songs", "ffmpeg_processes", "transcodes_running"):
+            lines.append(f"# TYPE voice_states_{name} gauge")
+            lines.append(f"voice_states_{name} {getattr(stats, name)}")
+        lines.append("# TYPE voice_state_memory_bytes gauge")
+        for (guild_id, size) in stats.memory_bytes.items():
+            lines.append(f'voice_state_memory_bytes{{guild="{guild_id}"}} {size}')
+        return "\n".join(lines) + "\n"
+
+
+def _is_alone(state: VoiceState) -> bool:
+    """Whether the bot's in a voice channel with no (non-bot) users"""
+    if state.voice is None or state.voice.channel is None:
+        return False
+    return not any(not member.bot for member in state.voice.channel.members)
+
+
+def _deep_size(obj, depth: int = 4) -> int:
+    """`obj`'s size in bytes, plus what it holds, `depth` levels down"""
+    if obj is None or isinstance(obj, (str, bytes, int, float)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, _SHARED_TYPES):
+        return 0
+    size = sys.getsizeof(obj)
+    if depth == 0:
+        return size
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key, depth - 1) + _deep_size(value, depth - 1) for (key, value) in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_size(item, depth - 1) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += _deep_size(vars(obj), depth - 1)
+    return size
+
+
+def _approximate_size(state: VoiceState) -> int:
+    """
+    Roughly how many bytes `state` (mostly its queue) uses.
+    Only `MEMORY_SAMPLE_SIZE` songs are measured, so it's quick even for huge queues
+    """
+    size = sys.getsizeof(state) + sys.getsizeof(vars(state)) + sys.getsizeof(state.gaps)
+    n_songs = len(state.songs)
+    if n_songs:
+        step = max(1, n_songs // MEMORY_SAMPLE_SIZE)
+        sample = [state.songs[i] for i in range(0, n_songs, step)][:MEMORY_SAMPLE_SIZE]
+        size += sum(_deep_size(song) for song in sample) * n_songs // len(sample)
+    if state.current is not None:
+        size += _deep_size(state.current)
+    return size
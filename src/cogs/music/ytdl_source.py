@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import os
 from typing import List
 
 import discord
@@ -8,6 +9,7 @@ import yt_dlp
 from discord.ext import commands
 
 from .abstract_audio import AbstractAudio
+from .latency_metrics import latency_metrics
 
 
 YTDL_OPTIONS = {
@@ -29,6 +31,9 @@ YTDL = yt_dlp.YoutubeDL(YTDL_OPTIONS)
 # YT-DLP uses a format selector to choose which version to download.
 # In our case, we want the one with best audio.
 FORMAT_SELECTOR = YTDL.build_format_selector(YTDL_OPTIONS['format'])
+# Discord streams Opus, so if there's an Opus version (YouTube usually has one), it can be sent without re-encoding.
+# Otherwise, fall back to the usual format
+OPUS_FORMAT_SELECTOR = YTDL.build_format_selector(f"{YTDL_OPTIONS['format']}[acodec=opus]/{YTDL_OPTIONS['format']}")
 
 FFMPEG_OPTIONS = {
     "options": "-vn",
@@ -39,10 +44,16 @@ class YTDLError(commands.CommandError):
     pass
 
 
-def _find_video_url(data: dict) -> str:
+def opus_passthrough_enabled() -> bool:
+    """Whether Opus streams are sent to Discord as-is. On unless `.env` has `OPUS_PASSTHROUGH=0`"""
+    return os.environ.get("OPUS_PASSTHROUGH", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def _find_video_format(data: dict, prefer_opus: bool = False) -> dict:
     """
     Searches the video information returned by yt-dlp, trying to find
-    the backing URL from which the bot can play.
+    the format (and its backing URL) from which the bot can play.
+    If `prefer_opus`, an Opus version is picked if there is one.
     """
     # Websites like YouTube can provide hundreds of different ways of seeing a video
     #  (The video at 144p, 720p, 1080p, audio only, auto-dubbed audio...)
@@ -51,11 +62,11 @@ def _find_video_url(data: dict) -> str:
     # YT-DLP figures out which one of these is the one you want, using
     #  the format string in a "format_selector"
     # https://github.com/yt-dlp/yt-dlp/blob/cec1f1df792fe521fff2d5ca54b5c70094b3d96a/yt_dlp/YoutubeDL.py#L3047
-    format_to_download = YTDL._select_formats(data['formats'], FORMAT_SELECTOR)
+    format_to_download = YTDL._select_formats(data['formats'], OPUS_FORMAT_SELECTOR if prefer_opus else FORMAT_SELECTOR)
     if len(format_to_download) == 0:
         raise YTDLError(f"Unable to find an audio version of {data['url']}")
     best_format = format_to_download[-1]
-    return best_format['url']
+    return best_format
 
 
 class YTDLSource(AbstractAudio):
@@ -115,7 +126,7 @@ class YTDLSource(AbstractAudio):
             for data in data_to_process
         ]
 
-    async def generate_source(self) -> discord.FFmpegPCMAudio:
+    async def generate_source(self) -> discord.AudioSource:
         loop = asyncio.get_event_loop()
         partial = lambda: YTDL.extract_info(
             self.url,
@@ -124,14 +135,22 @@ class YTDLSource(AbstractAudio):
             extra_info={"noplaylist": True},
         )
 
-        data = await loop.run_in_executor(None, partial)
+        with latency_metrics.timed("stream_extract"):
+            data = await loop.run_in_executor(None, partial)
 
         if data is None:
             raise YTDLError(f"Unable to find **{self.name}** ({self.url}).")
         
-        song_url = _find_video_url(data)
-
-        return discord.FFmpegPCMAudio(source=song_url, **FFMPEG_OPTIONS)
+        prefer_opus = opus_passthrough_enabled()
+        with latency_metrics.timed("url_selection"):
+            song_format = _find_video_format(data, prefer_opus)
+        song_url = song_format['url']
+
+        with latency_metrics.timed("ffmpeg_spawn"):
+            # Already Opus, so ffmpeg only has to copy it across, instead of decoding it (and us re-encoding it)
+            if prefer_opus and song_format.get('acodec') == 'opus':
+                return discord.FFmpegOpusAudio(song_url, codec="copy", **FFMPEG_OPTIONS)
+            return discord.FFmpegPCMAudio(source=song_url, **FFMPEG_OPTIONS)
 
     def create_embed(self):
         embed = (
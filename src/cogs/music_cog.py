@@ -6,10 +6,13 @@ Copyright (c) 2019 Valentin B.
 Modified by 64andy, 2021
 """
 
+import asyncio
+import itertools
 import logging
 import math
 import os.path
-from typing import Dict, List, Optional
+import time
+from typing import List, Optional, Set, Tuple
 
 import discord
 from discord import app_commands
@@ -17,21 +20,61 @@ from discord.ext import commands
 
 from .music.abstract_audio import AbstractAudio
 from .music.find_local_audio import LocalAudioLibrary
+from .music.latency_metrics import MetricsReporter, latency_metrics
+from .music.library_watcher import LibraryWatcher
 from .music.local_audio_source import LocalAudioSource
+from .music.opus_cache import LOOKAHEAD_SONGS, OpusCache
+from .music.queue_store import QueueSaver, RestoredQueue, SavedRequester, from_reference, load_queues
+from .music.song_data import SongData
 from .music.voice_state import VoiceError, VoiceState
+from .music.voice_state_manager import VoiceStateManager
 from .music.ytdl_source import YTDLError, YTDLSource
 
 EMPTY_QUEUE_MSG = 'Queue is empty.'
 
 logger = logging.getLogger(__name__)
 
+
+def _parse_music_folders(music_folder: str) -> List[str]:
+    """
+    `LOCAL_MUSIC_FOLDER` can list multiple folders, separated by `;` on Windows, or `:` elsewhere.
+    Missing folders, and folders inside another listed folder, are skipped
+    """
+    folders: List[str] = []
+    for folder in music_folder.split(os.pathsep):
+        if not folder.strip():
+            continue
+        folder = os.path.abspath(folder.strip())
+        if not os.path.isdir(folder):
+            logging.warning(f"Music folder {folder!r} doesn't exist, skipping it")
+        elif folder not in folders:
+            folders.append(folder)
+    nested = {folder for folder in folders for other in folders
+              if folder != other and folder.startswith(os.path.join(other, ""))}
+    for folder in nested:
+        logging.warning(f"Music folder {folder!r} is already inside another music folder, skipping it")
+    return [folder for folder in folders if folder not in nested]
+
+
 class MusicCog(commands.Cog):
     
     local_library: LocalAudioLibrary | None
+    library_watcher: LibraryWatcher | None
     
     def __init__(self, bot: commands.Bot, music_folder: Optional[str]):
         self.bot = bot
-        self.voice_states: Dict[int, VoiceState] = {}
+        # Every server's voice state, cleaned up once it's stopped or been left alone
+        self.voice_states = VoiceStateManager(bot)
+        self.local_library = None
+        self.library_watcher = None
+        self.opus_cache: Optional[OpusCache] = None
+        self._library_loader: Optional[asyncio.Task] = None
+        # Queues are saved as they change, and picked up again when the bot restarts
+        self.queue_saver = QueueSaver(self.voice_states)
+        self._queue_restorer: Optional[asyncio.Task] = None
+        # (Optional) How long each step of playing a song takes, for graphs/alerts
+        self.metrics_reporter = MetricsReporter(latency_metrics)
+        self.metrics_reporter.add_source(self.voice_states.prometheus_text)
         # Can we play local music?
         failed = False
         # 1. Is the folder set?
@@ -39,18 +82,23 @@ class MusicCog(commands.Cog):
             logging.warning(".env variable `LOCAL_MUSIC_FOLDER` not set. Playing local music is disabled.")
             del self._play_local
             return
-        # 2. Does the folder exist?
-        elif not os.path.isdir(music_folder):
+        # 2. Do the folders exist?
+        music_folders = _parse_music_folders(music_folder)
+        if not music_folders:
             logging.warning(".env variable `LOCAL_MUSIC_FOLDER` points to a non-existent folder")
             del self._play_local
             return
 
-        local_library = LocalAudioLibrary(music_folder)
-        # 3. Are there any songs?
-        if len(local_library.all_songs) == 0:
-            del self._play_local
-            return
+        # The songs are found in the background (see `cog_load`), so the bot can start straight away
+        local_library = LocalAudioLibrary(music_folders)
         self.local_library = local_library
+        # When sharded, only one worker watches the folders and keeps the Opus cache,
+        # so they don't all parse/encode the same songs into the same files
+        if getattr(bot, "owns_shared_files", True):
+            # Pick up songs being added/removed while the bot's running
+            self.library_watcher = LibraryWatcher(local_library)
+            # (Optional) Songs are encoded to Opus ahead of time, so playing them takes less CPU
+            self.opus_cache = OpusCache.from_env()
         self._play_local = app_commands.autocomplete(
                 title=self.local_library.get_autocomplete_suggestions('title'),
                 album=self.local_library.get_autocomplete_suggestions('album'),
@@ -61,17 +109,108 @@ class MusicCog(commands.Cog):
 
     def get_voice_state(self, channel: discord.TextChannel) -> VoiceState:
         """Gets the voice state of this"""
-        server_id = channel.guild.id
-        state = self.voice_states.get(server_id)
-        if not state or state.is_destroyed:
-            state = VoiceState(self.bot, channel)
-            self.voice_states[server_id] = state
-
-        return state
+        return self.voice_states.get_or_create(channel)
+
+    async def cog_load(self):
+        if self.local_library is not None:
+            self._library_loader = self.bot.loop.create_task(self._load_local_library())
+        self._queue_restorer = self.bot.loop.create_task(self._restore_queues())
+        self.voice_states.start()
+        await self.metrics_reporter.start()
+
+    async def _restore_queues(self):
+        """Carries on playing the queues that were saved before the bot restarted"""
+        await self.bot.wait_until_ready()
+        try:
+            saved_queues = await self.bot.loop.run_in_executor(None, load_queues)
+        except Exception as e:
+            logger.exception(e)
+            saved_queues = []
+        # When sharded, other processes restore the other shards' servers
+        saved_queues = [saved_queue for saved_queue in saved_queues if self._is_our_guild(saved_queue.guild_id)]
+        for saved_queue in saved_queues:
+            try:
+                await self._restore_queue(saved_queue)
+            except Exception as e:
+                logger.exception(e)
+        # Anything that couldn't be restored gets deleted on the first save
+        self.queue_saver.start(already_saved=[saved_queue.guild_id for saved_queue in saved_queues])
+
+    def _is_our_guild(self, guild_id: int) -> bool:
+        """Whether the server's on one of this process's shards (see `sharding.py`)"""
+        shard_ids = getattr(self.bot, "shard_ids", None)
+        if not shard_ids:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    async def _restore_queue(self, saved_queue: RestoredQueue):
+        text_channel = self.bot.get_channel(saved_queue.text_channel_id)
+        voice_channel = self.bot.get_channel(saved_queue.voice_channel_id)
+        if text_channel is None or voice_channel is None:
+            logger.info("Not restoring the queue for server %s, its channels are gone", saved_queue.guild_id)
+            return
+        songs = []
+        for reference in saved_queue.songs:
+            requester = self.bot.get_user(reference.requester_id) or SavedRequester(reference.requester_id)
+            audio = from_reference(reference, requester, self.opus_cache)
+            if audio is not None:
+                songs.append(audio)
+        if not songs:
+            return
+        logger.info("Restoring %s song(s) for server %s", len(songs), saved_queue.guild_id)
+        voice_state = self.get_voice_state(text_channel)
+        if not voice_state.voice:
+            voice_state.voice = await voice_channel.connect()
+        voice_state.loop = saved_queue.loop
+        voice_state.songs.put_many(songs)
+        await text_channel.send(f"I'm back! Picking up where I left off, with {len(songs)} song(s) queued")
+
+    async def _load_local_library(self):
+        if self.library_watcher is not None:
+            self.library_watcher.start()
+        try:
+            workers = os.environ.get("LOCAL_MUSIC_SCAN_WORKERS")
+            # Each folder's only watched once its initial scan's done, so they don't both parse the same files
+            await self.local_library.load(
+                workers=int(workers) if workers else None,
+                on_folder_loaded=self.library_watcher.watch if self.library_watcher is not None else None,
+            )
+        except Exception as e:
+            logger.exception(e)
+            return
+        if len(self.local_library.all_songs) == 0:
+            logger.warning("No songs found in `LOCAL_MUSIC_FOLDER`")
 
     async def cog_unload(self):
-        for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+        if self._library_loader is not None:
+            self._library_loader.cancel()
+        if self._queue_restorer is not None:
+            self._queue_restorer.cancel()
+        # Before the voice states are stopped (which empties their queues), so they're restored next time
+        try:
+            self.queue_saver.stop()
+        except Exception as e:
+            logger.exception(e)
+        if self.library_watcher is not None:
+            self.library_watcher.stop()
+        if self.local_library is not None:
+            self.local_library.close()
+        if self.opus_cache is not None:
+            self.opus_cache.close()
+        await self.voice_states.close()
+        await self.metrics_reporter.stop()
+
+    @commands.Cog.listener()
+    async def on_song_started(self, voice_state: VoiceState, audio: AbstractAudio):
+        # Counted once it plays, so songs that are skipped or cleared before then don't count
+        if self.local_library is not None and isinstance(audio, LocalAudioSource):
+            self.local_library.record_play(audio.song_data, already_counted=audio.counted_plays)
+        # Only the next few songs get cached (if the Opus cache is on), not the whole queue,
+        # so a long queue can't push out the songs that are about to play
+        if self.opus_cache is not None:
+            for upcoming in itertools.islice(voice_state.songs, LOOKAHEAD_SONGS):
+                if isinstance(upcoming, LocalAudioSource):
+                    self.opus_cache.request(upcoming.song_data.filepath)
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -132,8 +271,7 @@ class MusicCog(commands.Cog):
         if not voice_state.voice:
             return await ctx.send('Not connected to any voice channel.')
 
-        await voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        await self.voice_states.remove(ctx.guild.id)
 
     @commands.command(name='now', aliases=['current', 'playing', 'np'])
     async def _now(self, ctx: commands.Context):
@@ -243,8 +381,7 @@ class MusicCog(commands.Cog):
         if len(voice_state.songs) == 0:
             return await ctx.send(EMPTY_QUEUE_MSG)
 
-        song = voice_state.songs.pop(song_pos - 1)
-        voice_state.songs.insert(target_pos - 1, song)
+        voice_state.songs.move(song_pos - 1, target_pos - 1)
         await ctx.message.add_reaction('✅')
 
     @commands.command(name='loop')
@@ -272,19 +409,22 @@ class MusicCog(commands.Cog):
         This command automatically searches from various sites if no URL is provided.
         A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html
         """
+        requested_at = time.monotonic()
         voice_state = self.get_voice_state(ctx.channel)
 
         await self.join_voice_channel(voice_state, ctx.author)
 
         async with ctx.typing():
             try:
-                audio_to_add = await YTDLSource.from_query(search, ctx.author)
+                with latency_metrics.timed("extract", ctx.guild.id):
+                    audio_to_add = await YTDLSource.from_query(search, ctx.author)
             except YTDLError as e:
                 await ctx.send(f'An error occurred while processing this request: {str(e)}')
             else:
                 for song in audio_to_add:
-                    logger.info('putting the YT song: %s', song.name)
-                    await voice_state.songs.put(song)
+                    song.requested_at = requested_at
+                logger.info('putting %s YT song(s)', len(audio_to_add))
+                voice_state.songs.put_many(audio_to_add)
                 if len(audio_to_add) > 1:
                     await ctx.send(f'Enqueued {len(audio_to_add)} songs')
                 else:
@@ -313,6 +453,12 @@ class MusicCog(commands.Cog):
         # Has local music been set?
         if self.local_library is None:
             return await interaction.response.send_message("❌ Can't play local songs, as the bot runner hasn't set a music folder. Try the normal play command")
+        # Is it still being loaded? (Songs already found can be played, even if a slow folder's still going)
+        if not self.local_library.is_loaded and len(self.local_library.all_songs) == 0:
+            return await interaction.response.send_message(
+                f"⏳ The local music library is still indexing ({self.local_library.progress.percent}%). Try again soon.")
+        if len(self.local_library.all_songs) == 0:
+            return await interaction.response.send_message("❌ There aren't any songs in the local music folder.")
         # If they entered nothing, then error     
         if not title and not album and not artist:
             await interaction.response.send_message(
@@ -333,15 +479,24 @@ class MusicCog(commands.Cog):
         voice_state = self.get_voice_state(interaction.channel)
         await self.join_voice_channel(voice_state, interaction.user)
 
+        # Album picked from autocomplete: the tracklist's already known, no need to search
+        if album and not title:
+            album_songs = self.local_library.album_tracklist(album, artist=artist)
+            if album_songs:
+                return await self._enqueue_album(interaction, voice_state, album_songs)
+
         # Now, find the song they asked for
         possibilities = self.local_library.find_possible_songs(title=title, album=album, artist=artist)
         if len(possibilities) == 0:
-            return await interaction.response.send_message("Error: Couldn't find any songs from your search")
+            MSG = "Error: Couldn't find any songs from your search"
+            if not self.local_library.is_loaded:
+                MSG += f" (the library's still indexing, {self.local_library.progress.percent}% done)"
+            return await interaction.response.send_message(MSG)
         
         if title:
         # Song search: Find the *ONE* song they asked for
             audio_file = possibilities[0]
-            song = LocalAudioSource(audio_file, added_by=interaction.user)
+            song = self._local_audio_source(audio_file, interaction.user)
             logger.info('putting the local song: %s', song.name)
             MSG = f'Enqueued song: {song}'
             if len(possibilities) > 1:
@@ -349,14 +504,26 @@ class MusicCog(commands.Cog):
             await voice_state.songs.put(song)
             await interaction.response.send_message(MSG)
         elif album:
-        # Album search: Add every song in the specified album
-            possibilities.sort()
-            n_songs = len(possibilities)
-            logger.info("putting %s local song(s)", n_songs)
-            for audio_file in possibilities:
-                song = LocalAudioSource(audio_file, added_by=interaction.user)
-                await voice_state.songs.put(song)
-            await interaction.response.send_message(f'Enqueued {n_songs} songs from **{audio_file.album}**')
+        # Album search: Add every song in the specified album(s)
+            await self._enqueue_album(interaction, voice_state, self.local_library.in_album_order(possibilities))
+
+    async def _enqueue_album(self, interaction: discord.Interaction, voice_state: VoiceState, album_songs: List[SongData]):
+        """Adds the songs (already in tracklist order) to the queue, all at once"""
+        n_songs = len(album_songs)
+        logger.info("putting %s local song(s)", n_songs)
+        # The album (and artist) only count as played once, however many of its songs are played
+        counted_plays = set()
+        voice_state.songs.put_many(self._local_audio_source(audio_file, interaction.user, counted_plays)
+                                   for audio_file in album_songs)
+        await interaction.response.send_message(f'Enqueued {n_songs} songs from **{album_songs[0].album}**')
+
+    def _local_audio_source(self, audio_file: SongData, added_by: discord.User,
+                            counted_plays: Optional[Set[Tuple[str, str]]] = None) -> LocalAudioSource:
+        """Makes a song to queue up"""
+        audio = LocalAudioSource(audio_file, added_by=added_by, opus_cache=self.opus_cache,
+                                 counted_plays=counted_plays)
+        audio.requested_at = time.monotonic()
+        return audio
         
     
     @_join.before_invoke
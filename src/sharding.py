@@ -0,0 +1,252 @@
+"""
+Runs the bot's shards across several worker processes, so voice encoding, local music searching
+and yt-dlp calls for different servers don't all compete for one GIL.
+
+The supervisor (this process) starts one worker per shard range, restarts any that crash or stop
+sending heartbeats, and logs each shard's health. Turned on by setting `SHARD_COUNT` in the .env file.
+
+The workers share the supervisor's config (they inherit its environment, .env included), and
+the local music library's tag cache: it's brought up to date once before the workers start,
+so each worker builds its index straight from the cache, without re-parsing any music files.
+"""
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import List, NamedTuple, Optional
+
+import discord
+
+HEARTBEAT_SECONDS = 15              # How often workers report their shards' health
+HEARTBEAT_TIMEOUT_SECONDS = 180     # A worker that's been quiet this long is restarted
+HEALTH_LOG_SECONDS = 300            # How often the supervisor logs every shard's health
+RESTART_DELAY_SECONDS = 5           # Doubles every time a worker's restarted in a row, up to...
+MAX_RESTART_DELAY_SECONDS = 300
+STABLE_SECONDS = 600                # A worker that's been running this long has its restart delay reset
+SHUTDOWN_TIMEOUT_SECONDS = 30       # How long workers get to save their queues and disconnect
+
+logger = logging.getLogger(__name__)
+
+
+class ShardHealth(NamedTuple):
+    shard_id: int
+    latency: float          # Seconds, to Discord's gateway. Infinite if it's not connected
+    guilds: int
+    is_closed: bool
+
+
+class WorkerHealth(NamedTuple):
+    worker: int
+    pid: int
+    shards: List[ShardHealth]
+    voice_states: int       # Servers the worker's playing music in (or about to)
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[List[int]]:
+    """Splits the shards into `processes` (roughly) equal, contiguous ranges"""
+    processes = max(1, min(processes, shard_count))
+    per_process = math.ceil(shard_count / processes)
+    return [list(range(start, min(start + per_process, shard_count)))
+            for start in range(0, shard_count, per_process)]
+
+
+# ----- Worker processes -----
+def run_worker(worker: int, shard_ids: List[int], shard_count: int, token: str,
+               health_queue: "multiprocessing.Queue"):
+    """Runs a bot for `shard_ids`, until it's told to stop"""
+    discord.utils.setup_logging()
+    # Each worker serves its metrics on its own port, right after the previous worker's
+    metrics_port = os.environ.get("METRICS_PORT")
+    if metrics_port:
+        os.environ["METRICS_PORT"] = str(int(metrics_port) + worker)
+
+    from .__main__ import MyShardedBot, create_bot
+    bot = create_bot(MyShardedBot, shard_ids=shard_ids, shard_count=shard_count)
+    bot.sync_commands = worker == 0
+    bot.owns_shared_files = worker == 0
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        try:
+            # So being stopped by the supervisor still saves queues, disconnects, etc.
+            loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+        except NotImplementedError:
+            # Windows
+            pass
+        async with bot:
+            heartbeat = loop.create_task(_send_heartbeats(bot, worker, health_queue))
+            try:
+                await bot.start(token)
+            finally:
+                heartbeat.cancel()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+async def _send_heartbeats(bot: discord.AutoShardedClient, worker: int, health_queue: "multiprocessing.Queue"):
+    while True:
+        guilds_per_shard = Counter(guild.shard_id for guild in bot.guilds)
+        shards = [
+            ShardHealth(
+                shard_id=shard_id,
+                latency=shard.latency if not shard.is_closed() else math.inf,
+                guilds=guilds_per_shard[shard_id],
+                is_closed=shard.is_closed(),
+            )
+            for (shard_id, shard) in sorted(bot.shards.items())
+        ]
+        music_cog = bot.get_cog("MusicCog")
+        voice_states = len(music_cog.voice_states) if music_cog is not None else 0
+        health_queue.put(WorkerHealth(worker, os.getpid(), shards, voice_states))
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+
+
+def _update_tag_cache():
+    """Scans the music folders once, so every worker can load the library straight from the tag cache"""
+    discord.utils.setup_logging()
+    from .cogs.music.find_local_audio import LocalAudioLibrary
+    from .cogs.music_cog import _parse_music_folders
+    music_folders = _parse_music_folders(os.environ["LOCAL_MUSIC_FOLDER"])
+    if not music_folders:
+        return
+    library = LocalAudioLibrary(music_folders)
+    workers = os.environ.get("LOCAL_MUSIC_SCAN_WORKERS")
+    asyncio.run(library.load(workers=int(workers) if workers else None))
+    library.close()
+
+
+# ----- The supervisor -----
+@dataclass
+class _Worker:
+    index: int
+    shard_ids: List[int]
+    process: Optional[multiprocessing.Process] = None
+    started_at: float = 0.0
+    last_heartbeat: float = 0.0
+    health: Optional[WorkerHealth] = None
+    restart_delay: float = RESTART_DELAY_SECONDS
+    start_after: float = field(default_factory=time.monotonic)
+
+
+def run_supervisor(token: str, shard_count: int, processes: Optional[int] = None):
+    """
+    Runs `shard_count` shards, split between `processes` worker processes (by default, one per CPU core).
+    Returns once it's interrupted (e.g. Ctrl+C), after stopping the workers
+    """
+    discord.utils.setup_logging()
+    # Spawned rather than forked, so no worker inherits another's event loop, threads or database connections
+    context = multiprocessing.get_context("spawn")
+
+    if os.environ.get("LOCAL_MUSIC_FOLDER"):
+        logger.info("Updating the local music tag cache before starting the shards...")
+        scanner = context.Process(target=_update_tag_cache, name="tag-cache-update")
+        scanner.start()
+        scanner.join()
+
+    ranges = shard_ranges(shard_count, processes or os.cpu_count() or 1)
+    workers = [_Worker(index, shard_ids) for (index, shard_ids) in enumerate(ranges)]
+    health_queue = context.Queue()
+    logger.info(f"Running {shard_count} shard(s) in {len(workers)} process(es): {ranges}")
+
+    last_health_log = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            for worker in workers:
+                _check_worker(worker, context, token, shard_count, health_queue, now)
+            _receive_heartbeats(workers, health_queue)
+            if now - last_health_log >= HEALTH_LOG_SECONDS:
+                last_health_log = now
+                _log_health(workers)
+    except KeyboardInterrupt:
+        logger.info("Stopping the shards...")
+    finally:
+        _stop_workers(workers)
+
+
+def _check_worker(worker: _Worker, context, token: str, shard_count: int,
+                  health_queue: "multiprocessing.Queue", now: float):
+    """Starts the worker if it's not running, and restarts it if it's crashed or stopped responding"""
+    process = worker.process
+    if process is not None and process.is_alive():
+        if now - worker.last_heartbeat < HEARTBEAT_TIMEOUT_SECONDS:
+            if now - worker.started_at >= STABLE_SECONDS:
+                worker.restart_delay = RESTART_DELAY_SECONDS
+            return
+        logger.warning(f"Worker {worker.index} (shards {worker.shard_ids}) hasn't sent a heartbeat for "
+                       f"{now - worker.last_heartbeat:.0f}s, restarting it")
+        process.terminate()
+        process.join(SHUTDOWN_TIMEOUT_SECONDS)
+        if process.is_alive():
+            process.kill()
+            process.join()
+    if process is not None:
+        logger.warning(f"Worker {worker.index} (shards {worker.shard_ids}) stopped with exit code "
+                       f"{process.exitcode}, restarting it in {worker.restart_delay:.0f}s")
+        worker.process = None
+        worker.health = None
+        worker.start_after = now + worker.restart_delay
+        worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY_SECONDS)
+    if now < worker.start_after:
+        return
+    worker.process = context.Process(
+        target=run_worker, name=f"shard-worker-{worker.index}",
+        args=(worker.index, worker.shard_ids, shard_count, token, health_queue),
+    )
+    worker.process.start()
+    # Counts as a heartbeat, so it has time to log in before it's expected to send any
+    worker.started_at = worker.last_heartbeat = now
+
+
+def _receive_heartbeats(workers: List[_Worker], health_queue: "multiprocessing.Queue"):
+    """Waits up to a second for heartbeats, recording any that arrive"""
+    try:
+        health: WorkerHealth = health_queue.get(timeout=1)
+    except queue.Empty:
+        return
+    while True:
+        worker = workers[health.worker]
+        # Ignore heartbeats a restarted worker sent before it stopped
+        if worker.process is not None and worker.process.pid == health.pid:
+            worker.health = health
+            worker.last_heartbeat = time.monotonic()
+        try:
+            health = health_queue.get_nowait()
+        except queue.Empty:
+            return
+
+
+def _log_health(workers: List[_Worker]):
+    lines = []
+    for worker in workers:
+        if worker.health is None:
+            lines.append(f"worker {worker.index} (shards {worker.shard_ids}): starting")
+            continue
+        lines.append(f"worker {worker.index} (pid {worker.health.pid}): {worker.health.voice_states} voice state(s)")
+        for shard in worker.health.shards:
+            status = "closed" if shard.is_closed else f"{shard.latency * 1000:.0f}ms"
+            lines.append(f"  shard {shard.shard_id}: {status}, {shard.guilds} server(s)")
+    logger.info("Shard health:\n%s", "\n".join(lines))
+
+
+def _stop_workers(workers: List[_Worker]):
+    """Asks every worker to stop (so they save their queues), then kills any that don't in time"""
+    processes = [worker.process for worker in workers if worker.process is not None and worker.process.is_alive()]
+    for process in processes:
+        process.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+    for process in processes:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.warning(f"{process.name} didn't stop in time, killing it")
+            process.kill()
+            process.join()